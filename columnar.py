@@ -0,0 +1,189 @@
+import os
+import sys
+import json
+import mmap
+import bisect
+import spill
+import fingerprints
+from array import array
+
+#
+# Memory-mapped columnar copy of the peak tables of a study (see the export_columnar command).
+#
+# Every table is written, sorted by m/z, as one binary file per column into <study>.columnar/ (i.e. next to the
+# .sqlite3 file). Values keep the integer encoding of the study (see mass_translation_factor and
+# time_translation_factor), so that readers can apply exactly the same (integer) range logic as their SQL queries, and
+# the rowid of every peak is kept so that peaks of equal intensity can be ordered as the SQL queries order them.
+#
+# meta.json records the content digest of the study file the store was exported from (see fingerprints.digest, which
+# plz computes anyway for every file argument, so that checking it costs nothing as long as the file is unchanged):
+# any change to the study, in-place UPDATEs included, makes the store out of date. The index command, which only adds
+# indexes, re-stamps an up to date store with the digest of the indexed study.
+#
+
+TABLES = {
+    "ms1_peaks": (("mz", "i"), ("rt", "i"), ("intensity", "d"), ("rawfile", "h"), ("rowid", "q")),
+    "ms2_peaks": (("mz", "i"), ("rt", "i"), ("intensity", "d"), ("rawfile", "h"), ("precursor", "i"), ("rowid", "q")),
+}
+
+EXPORT_CHUNK = 1000000
+
+
+def store_path(study):
+    if study.endswith(".sqlite3"):
+        study = study[:(-8)]
+    return study + ".columnar"
+
+
+def study_path(cur):
+    for (_, name, filename) in cur.execute("PRAGMA database_list"):
+        if name == "main":
+            return filename
+    return None
+
+
+def export(con, study, mass_translation_factor, time_translation_factor, progress=None):
+    cur = con.cursor()
+    directory = store_path(study)
+    os.makedirs(directory, exist_ok=True)
+    meta = {
+        "study": list(fingerprints.digest(study)),
+        "byteorder": sys.byteorder,
+        "mass_translation_factor": mass_translation_factor,
+        "time_translation_factor": time_translation_factor,
+        "tables": {},
+    }
+    for (table, columns) in TABLES.items():
+        names = [name for (name, _) in columns]
+        files = [open(os.path.join(directory, f"{table}.{name}"), "wb") for name in names]
+        cur.execute(f"SELECT {', '.join(names)} FROM {table} ORDER BY mz, rt, rawfile, intensity, rowid")
+        count = 0
+        while True:
+            rows = cur.fetchmany(EXPORT_CHUNK)
+            if not rows:
+                break
+            for (offset, (_, typecode)) in enumerate(columns):
+                # array() refuses values that do not fit the column type rather than silently truncating them...
+                array(typecode, [row[offset] for row in rows]).tofile(files[offset])
+            count += len(rows)
+            if progress:
+                progress(table, count)
+        for f in files:
+            f.close()
+        meta["tables"][table] = {"rows": count, "columns": dict(columns)}
+    write_meta(study, meta)
+    return meta
+
+
+def read_meta(study):
+    # the meta.json of the columnar store of study, or None when there is none
+    try:
+        with open(os.path.join(store_path(study), "meta.json")) as f:
+            return json.load(f)
+    except OSError:
+        return None
+
+
+def write_meta(study, meta):
+    with open(os.path.join(store_path(study), "meta.json"), "w") as f:
+        json.dump(meta, f, indent=1)
+
+
+def is_current(study, meta):
+    # whether the store (described by meta) was exported from study as it is now
+    return meta.get("study") == list(fingerprints.digest(study))
+
+
+def restamp(study):
+    # records the current digest of study in its columnar store, which must have been up to date before study changed
+    # without its peaks changing (e.g. indexed)
+    meta = read_meta(study)
+    meta["study"] = list(fingerprints.digest(study))
+    write_meta(study, meta)
+
+
+class PeakTable:
+    def __init__(self, directory, table, columns, rows):
+        self.rows = rows
+        self._maps = []
+        for (name, typecode) in columns.items():
+            setattr(self, name, self._column(os.path.join(directory, f"{table}.{name}"), typecode))
+
+    def _column(self, filename, typecode):
+        if not self.rows:
+            return memoryview(array(typecode))
+        with open(filename, "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps.append(mapped)
+        column = memoryview(mapped).cast(typecode)
+        assert len(column) == self.rows
+        return column
+
+    def __len__(self):
+        return self.rows
+
+    def mz_range(self, mz_low, mz_high):
+        # (start, stop) offsets of the peaks with mz_low <= mz <= mz_high (raw integer m/z values)
+        return (bisect.bisect_left(self.mz, mz_low), bisect.bisect_right(self.mz, mz_high))
+
+    def by_intensity(self, min_intensity, start=0, stop=None, batch=0, spill_to_disk=False):
+        # offsets of the (rawfile > 0) peaks more intense than min_intensity, most intense first
+        if stop is None:
+            stop = self.rows
+        offsets = (
+            offset
+            for (offset, intensity, rawfile) in zip(range(start, stop), self.intensity[start:stop], self.rawfile[start:stop])
+            if intensity > min_intensity and rawfile > 0
+        )
+        return self.most_intense_first(offsets, batch, spill_to_disk)
+
+    def most_intense_first(self, offsets, batch=0, spill_to_disk=False):
+        # equally intense peaks come out in rowid order, as they do from "ORDER BY intensity DESC, rowid" queries: a
+        # list, or (with batch > 0 and spill_to_disk) a generator of offsets sorted in runs of batch peaks spilled to
+        # disk (in the current directory) and merged back as they are consumed (see spill.py)
+        intensity = self.intensity
+        rowid = self.rowid
+        keys = ((-intensity[offset], rowid[offset], offset) for offset in offsets)
+        if batch > 0 and spill_to_disk:
+            return (offset for (_, _, offset) in spill.sort(keys, batch, "dqq", directory="."))
+        return [offset for (_, _, offset) in sorted(keys)]
+
+    def fetch(self, offsets, *names):
+        columns = [getattr(self, name) for name in names]
+        for offset in offsets:
+            yield tuple(column[offset] for column in columns)
+
+
+class Store:
+    def __init__(self, directory, meta):
+        self.directory = directory
+        self.meta = meta
+        self.mass_translation_factor = meta["mass_translation_factor"]
+        self.time_translation_factor = meta["time_translation_factor"]
+        self.tables = {}
+        for (table, description) in meta["tables"].items():
+            self.tables[table] = PeakTable(directory, table, description["columns"], description["rows"])
+
+    def __getitem__(self, table):
+        return self.tables[table]
+
+
+def open_store(cur):
+    # The columnar store of the study behind cur, or None when there is none (or when it no longer matches the study,
+    # in which case the commands simply go back to querying the study itself).
+    study = study_path(cur)
+    if not study:
+        return None
+    directory = store_path(study)
+    meta = read_meta(study)
+    if meta is None:
+        return None
+    if meta["byteorder"] != sys.byteorder or meta["tables"].keys() != TABLES.keys() or any(
+        meta["tables"][table]["columns"] != dict(columns) for (table, columns) in TABLES.items()
+    ):
+        print(f"Ignoring incompatible columnar store {directory}!", file=sys.stderr, flush=True)
+        return None
+    if not is_current(study, meta):
+        print(f"Ignoring out of date columnar store {directory} (please re-run export_columnar)!", file=sys.stderr, flush=True)
+        return None
+    return Store(directory, meta)
@@ -1,4 +1,10 @@
 import sys
+import itertools
+from array import array
+
+WRITE_BUFFER_SIZE = 1024 * 1024
+WRITE_BATCH = 10000
+LOAD_CHUNK = 10000
 
 
 class Thing:
@@ -21,14 +27,12 @@ def enum(options):
     return __effectively_enums_are_strings__
 
 
-def loader(filename, header_description):
+def _match_headers(filename, headers, header_description):
+    # ({offset: description or None}, unmatched fields, unexpected headers) of the headers of filename, exiting when
+    # a required header is missing
     for available in header_description:
         assert header_description[available]["field"] != "rest_of_row"
-    f = open(filename)
-    headers = f.readline().strip(" \r\n").split("\t")
-    header_count = len(headers)
     to_parse = {}
-    matched = {}
     matched_headers = []
     unexpected = []
     unmatched = []
@@ -37,7 +41,6 @@ def loader(filename, header_description):
         for available in header_description:
             if header == available:
                 to_parse[offset] = header_description[available]
-                matched[header_description[available]["field"]] = offset
                 matched_headers.append(available)
                 matched_it = True
                 break
@@ -54,21 +57,178 @@ def loader(filename, header_description):
                 sys.exit(-1)
             else:
                 unmatched.append(header_description[available]["field"])
+    return (to_parse, unmatched, unexpected)
 
-    rows = []
-    for line in f:
-        new_row = Thing()
-        vals = line.strip(" \r\n").split("\t")
-        others = []
-        for i in range(header_count):
-            if to_parse[i]:
-                new_row[to_parse[i]["field"]] = (to_parse[i]["constructor"])(vals[i])
-            else:
-                others.append(vals[i])
-        if others:
-            new_row["rest_of_row"] = "\t".join(others)
-        rows.append(new_row)
-    return (rows, unmatched, unexpected)
+
+def _typed_column(constructor, values):
+    # the cells of a column, all converted at once (into an array for int and float columns)
+    if constructor is int or constructor is float:
+        try:
+            return array("q" if constructor is int else "d", map(constructor, values))
+        except OverflowError:
+            pass
+    return list(map(constructor, values))
+
+
+def _extend_column(column, more):
+    # column followed by more (both made by _typed_column), which stays an array as long as both are
+    if isinstance(column, array) and not isinstance(more, array):
+        column = list(column)
+    column.extend(more)
+    return column
+
+
+class Table:
+    # The rows of a file loaded column by column: columns maps every field to the sequence of its values
+    def __init__(self, columns, row_count):
+        self.columns = columns
+        self.row_count = row_count
+
+    def __len__(self):
+        return self.row_count
+
+    def rows(self):
+        # lightweight (__slots__) views of the rows, reading and writing through to the columns
+        view = _view_class(tuple(self.columns))
+        return [view(self.columns, index) for index in range(self.row_count)]
+
+
+_view_classes = {}
+
+
+def _view_class(fields):
+    if fields not in _view_classes:
+        def field_property(field):
+            def get(self):
+                return self._columns[field][self._index]
+
+            def put(self, value):
+                self._columns[field][self._index] = value
+
+            return property(get, put)
+
+        def __init__(self, columns, index):
+            self._columns = columns
+            self._index = index
+
+        namespace = {field: field_property(field) for field in fields}
+        namespace.update(
+            __slots__=("_columns", "_index"),
+            __init__=__init__,
+            __getitem__=Thing.__getitem__,
+            __setitem__=Thing.__setitem__,
+        )
+        _view_classes[fields] = type("Row", (), namespace)
+    return _view_classes[fields]
+
+
+def load_columns(filename, header_description):
+    # Same as loader, but returning a Table: every column is parsed in bulk (and kept in a typed array if possible),
+    # LOAD_CHUNK lines at a time, so that only the cells of a single chunk are ever held as strings
+    with open(filename) as f:
+        headers = f.readline().strip(" \r\n").split("\t")
+        header_count = len(headers)
+        (to_parse, unmatched, unexpected) = _match_headers(filename, headers, header_description)
+        columns = {}
+        for offset in range(header_count):
+            if to_parse[offset]:
+                columns[to_parse[offset]["field"]] = _typed_column(to_parse[offset]["constructor"], ())
+        has_others = None in to_parse.values()
+        if has_others:
+            columns["rest_of_row"] = []
+        row_count = 0
+        while True:
+            cells = [line.strip(" \r\n").split("\t") for line in itertools.islice(f, LOAD_CHUNK)]
+            if not cells:
+                break
+            for (number, vals) in enumerate(cells, row_count + 2):
+                if len(vals) < header_count:
+                    raise ValueError(f"line {number} of {filename} has {len(vals)} columns instead of {header_count}")
+            by_column = list(zip(*cells))
+            del cells
+            others = []
+            for offset in range(header_count):
+                if to_parse[offset]:
+                    field = to_parse[offset]["field"]
+                    columns[field] = _extend_column(columns[field], _typed_column(to_parse[offset]["constructor"], by_column[offset]))
+                else:
+                    others.append(by_column[offset])
+            if has_others:
+                columns["rest_of_row"].extend("\t".join(values) for values in zip(*others))
+            row_count += len(by_column[0])
+            del by_column, others
+    return (Table(columns, row_count), unmatched, unexpected)
+
+
+def iter_loader(filename, header_description):
+    # Same as loader, but the rows (Things) are parsed one at a time, as the returned generator gets consumed
+    f = open(filename)
+    headers = f.readline().strip(" \r\n").split("\t")
+    header_count = len(headers)
+    (to_parse, unmatched, unexpected) = _match_headers(filename, headers, header_description)
+
+    def rows():
+        with f:
+            for line in f:
+                new_row = Thing()
+                vals = line.strip(" \r\n").split("\t")
+                others = []
+                for i in range(header_count):
+                    if to_parse[i]:
+                        new_row[to_parse[i]["field"]] = (to_parse[i]["constructor"])(vals[i])
+                    else:
+                        others.append(vals[i])
+                if others:
+                    new_row["rest_of_row"] = "\t".join(others)
+                yield new_row
+
+    return (rows(), unmatched, unexpected)
+
+
+def loader(filename, header_description):
+    (rows, unmatched, unexpected) = iter_loader(filename, header_description)
+    return (list(rows), unmatched, unexpected)
+
+
+class Writer:
+    # Tab separated output of rows, declared once as (header, format) columns: a format is a %-format consuming as many
+    # values as it has conversions (possibly none, for constant columns, or more than one), so that every row is
+    # formatted by a single % operation, and rows are written in batches through a large buffer
+    def __init__(self, filename, columns):
+        self.out = open(filename, "w", buffering=WRITE_BUFFER_SIZE)
+        self.row_format = "\t".join(format for (_, format) in columns) + "\n"
+        self.out.write("\t".join(header for (header, _) in columns) + "\n")
+        self.row_count = 0
+
+    def write(self, values):
+        # values is the (flat) tuple of the values of every column
+        self.out.write(self.row_format % values)
+        self.row_count += 1
+
+    def format(self, values):
+        # the line write would write for values, e.g. to be written later (and possibly out of order) with write_text
+        return self.row_format % values
+
+    def write_text(self, text):
+        # writes lines made by format
+        self.out.write(text)
+        self.row_count += text.count("\n")
+
+    def write_rows(self, rows):
+        row_format = self.row_format
+        rows = iter(rows)
+        while True:
+            batch = [row_format % values for values in itertools.islice(rows, WRITE_BATCH)]
+            if not batch:
+                break
+            self.out.write("".join(batch))
+            self.row_count += len(batch)
+
+    def flush(self):
+        self.out.flush()
+
+    def close(self):
+        self.out.close()
 
 
 # Usage example:
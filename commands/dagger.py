@@ -0,0 +1,32 @@
+# pipeline: .plz
+# JOBS: 3
+import sys
+import time
+import pipelines
+import plz
+
+start_time = time.time()
+
+__version__ = "0.1"
+
+#
+# Runs every step of a pipeline (see pipelines.py for the format of .plz files), in dependency order, with up to JOBS
+# independent steps running at the same time. Each step logs into a <this command>_<step>.log file.
+#
+
+if JOBS < 1:
+    print("JOBS must be at least 1!!!", file=sys.stderr, flush=True)
+    sys.exit(-1)
+
+try:
+    failed = pipelines.run(pipeline, JOBS, plz, __file__[:-3])
+except ValueError as e:
+    print(f"Invalid pipeline {pipeline}: {e}", file=sys.stderr, flush=True)
+    sys.exit(-1)
+
+stop_time = time.time()
+
+if failed:
+    print(f"Pipeline {pipeline} failed ({', '.join(failed)}) after {stop_time - start_time :.2f} seconds.", file=sys.stderr, flush=True)
+    sys.exit(-1)
+print(f"Pipeline {pipeline} completed in {stop_time - start_time :.2f} seconds.", file=sys.stderr, flush=True)
@@ -4,12 +4,20 @@
 # LipidBLAST: False True
 # decoy: True False
 # HITS: 1
-# output: .features
+# WORKERS: 1
+# INCREMENTAL: True False
+# output: .features .mgf .txt .hits
+# reusable: False
+import os
 import sys
 import time
 import sqlite3
+import spectra
+import ledger
+import hits
 import subprocess
 import mspepsearch
+import metrics
 
 
 start_time = time.time()
@@ -104,13 +112,12 @@ except:
 
 FILE_SQL = """SELECT rawfile.id, rawfile.name FROM rawfile WHERE rawfile.id > 0 ORDER BY rawfile.id ASC"""
 SCAN_SQL = """SELECT scans.scan_ID, scans.rt, scans.precursor, scans.scan_type FROM scans WHERE scans.rawfile = ? ORDER BY scans.scan_ID ASC"""
-PEAK_SQL = """SELECT ms2_peaks.rawfile, ms2_peaks.rt, ms2_peaks.mz, ms2_peaks.intensity FROM ms2_peaks WHERE ms2_peaks.rawfile > 0 ORDER BY ms2_peaks.rawfile ASC, ms2_peaks.rt ASC, ms2_peaks.mz ASC"""
 
 all_filenames = {}
 for x in cur.execute(FILE_SQL):
     all_filenames[x[0]] = x[1]
 
-seq_name = study[:-8]
+seq_name = __file__[:-3]  # i.e. per run, so that concurrent dewey runs on the same study do not collide
 
 scan_loader_start = time.time()
 scan_loader_counter = 0
@@ -129,6 +136,7 @@ for (rawid, fname) in all_filenames.items():
             scans[x[1]] = [x[0], x[2], prev_ms1]
     all_scans[rawid] = scans
 scan_loader_stop = time.time()
+metrics.record("scan_loading", scan_loader_stop - scan_loader_start, scans=scan_loader_scan_counter)
 print(f"{scan_loader_scan_counter} scans loaded in {scan_loader_stop - scan_loader_start:.2f} seconds", file=sys.stderr, flush=True)
 
 #
@@ -137,66 +145,99 @@ print(f"{scan_loader_scan_counter} scans loaded in {scan_loader_stop - scan_load
 
 mgf_make_start = time.time()
 
-mgf = open(seq_name + ".mgf", 'w')
+mgf = spectra.MgfWriter(seq_name + ".mgf", all_filenames, all_scans, mass_translation_factor, time_translation_factor, digest=(INCREMENTAL == "True"))
 
 start_query = time.time()
-prev_rt = -1
-prev_rawid = None
-scan_count = 0
-peak_count = 0
-peaks = []  # Technically this gets taken care of in the loop, but still, defensive programming etc...
-peak_counter = 0  # TODO: duplicate counter used purely for visual feedback, should be removed.
-for (rawid, rt, mz, intensity) in cur.execute(PEAK_SQL):
-    # NOTE: rt and mz are still raw integers unmodified by time and mass factors!!!
-    peak_counter += 1
-    if not (peak_counter % 100000):
-        print(f"peaks processed = {peak_counter} ", flush=True)
-    if rawid != prev_rawid or rt != prev_rt:
-        # Finalize Scan...
-        if scan_count > 0:
-            for (m, i) in peaks:
-                print(f"{m} {i}", file=mgf)
-            print("END IONS\n", file=mgf)
-        peaks = []
-        prev_rt = rt
-        prev_rawid = rawid
-        scan_count += 1
-        pepmass = all_scans[rawid][rt][1]  # this is still a raw mz integer from the sqlite file...
-        print("BEGIN IONS", file=mgf)
-        if pepmass > 0:
-            print(f"TITLE={all_filenames[rawid]}.{all_scans[rawid][rt][0]}.+", file=mgf)
-            print("CHARGE=127+", file=mgf)
-        else:
-            print(f"TITLE={all_filenames[rawid]}.{all_scans[rawid][rt][0]}.-", file=mgf)
-            print("CHARGE=128-", file=mgf)
-        print(f"RTINSECONDS={float(rt / time_translation_factor)}", file=mgf)
-        if pepmass > 0:
-            print(f"PEPMASS={float(pepmass / mass_translation_factor)}", file=mgf)
-        else:
-            print(f"PEPMASS={-1 * float(pepmass / mass_translation_factor)}", file=mgf)
-    peak_count += 1
-    if mz < 0:
-        peaks = [(float( (-mz) / mass_translation_factor) , intensity)] + peaks
-    else:
-        peaks.append((float(mz / mass_translation_factor), intensity))
-# Finalize Last Scan...
-if scan_count > 0:
-    for (m, i) in peaks:
-        print(f"{m} {i}", file=mgf)
-    print("END IONS\n", file=mgf)
+mgf.write_study(cur)
 stop_query = time.time()
 mgf.close()
+mgf.report()
+scan_count = mgf.scan_count
+peak_count = mgf.peak_count
 
 mgf_make_stop = time.time()
+metrics.record("mgf", mgf_make_stop - mgf_make_start, scans=scan_count, peaks=peak_count)
 print(f"MGF created in {mgf_make_stop - mgf_make_start:.2f} seconds.", file=sys.stderr, flush=True)
 print(f"sql2mgf phase processed {peak_count} peaks and {scan_count} scans from {len(all_filenames)} files in {mgf_make_stop - start_time :.2f} seconds.", file=sys.stderr, flush=True)
 print("", file=sys.stderr, flush=True)
 print("----------------", file=sys.stderr, flush=True)
 print("", file=sys.stderr, flush=True)
 if mspepsearch.platform == "win32":
-    subprocess.run([mspepsearch.path, "d", "a", "v", "l", "G", "/Z", "0.01", "/M", "0.05", "/MatchPolarity", "/INP", seq_name + ".mgf"] + libraries + ["/OUTTAB", seq_name + ".txt", "/HITS", f"{HITS}", "/MinMF", "1", "/OutPrecursorType", "/OutIK", "/OutChemForm", "/OutPrecursorMZ", "/OnlyFound"], stdout=subprocess.DEVNULL, shell=True)
+    search_options = ["d", "a", "v", "l", "G", "/Z", "0.01", "/M", "0.05", "/MatchPolarity"]
+    output_options = ["/OutPrecursorType", "/OutIK", "/OutChemForm", "/OutPrecursorMZ", "/OnlyFound"]
 else:
-    subprocess.run([mspepsearch.path, "d", "a", "v", "l", "G", "/Z", "0.01", "/M", "0.05", "/INP", seq_name + ".mgf"] + libraries + ["/OUTTAB", seq_name + ".txt", "/HITS", f"{HITS}", "/MinMF", "1", "/OutPrecursorType", "/OutChemForm", "/OutPrecursorMZ", "/OnlyFound"], stdout=subprocess.DEVNULL)
+    search_options = ["d", "a", "v", "l", "G", "/Z", "0.01", "/M", "0.05"]
+    output_options = ["/OutPrecursorType", "/OutChemForm", "/OutPrecursorMZ", "/OnlyFound"]
+
+
+def search_command(mgf_name, txt_name):
+    return [mspepsearch.path] + search_options + ["/INP", mgf_name] + libraries + ["/OUTTAB", txt_name, "/HITS", f"{HITS}", "/MinMF", "1"] + output_options
+
+
+def search(mgf_name, txt_name, mgf_scan_count):
+    if WORKERS <= 1 or mgf_scan_count <= 1:
+        subprocess.run(search_command(mgf_name, txt_name), stdout=subprocess.DEVNULL, shell=(mspepsearch.platform == "win32"))
+        return
+    # Library search is CPU bound (and single threaded), so the MGF gets split into WORKERS chunks of consecutive scans,
+    # searched concurrently, and the results are concatenated in chunk (i.e. scan) order...
+    chunks = spectra.split_mgf(mgf_name, WORKERS, mgf_scan_count)
+    searches = [
+        subprocess.Popen(search_command(chunk, chunk[:(-4)] + ".txt"), stdout=subprocess.DEVNULL, shell=(mspepsearch.platform == "win32"))
+        for chunk in chunks
+    ]
+    failed = [chunk for (chunk, search) in zip(chunks, searches) if search.wait() != 0]
+    if failed:
+        print(f"MSPepSearch failed on {', '.join(failed)}!!!", file=sys.stderr, flush=True)
+        sys.exit(-1)
+    with open(txt_name, "w") as merged:
+        for (number, chunk) in enumerate(chunks):
+            with open(chunk[:(-4)] + ".txt") as part:
+                for line in part:
+                    # the header lines of every chunk but the first would only be skipped below anyway...
+                    if number > 0 and hits.is_header(line):
+                        continue
+                    merged.write(line)
+    for chunk in chunks:
+        os.remove(chunk)
+        os.remove(chunk[:(-4)] + ".txt")
+
+
+search_start = time.time()
+searched_count = scan_count
+if INCREMENTAL == "True":
+    # Only the rawfiles which were not searched yet (or whose scans changed since) are searched, the hits of the other
+    # ones come from the ledger of the study...
+    searched = ledger.Ledger(study, ledger.search_key(search_command("", ""), libraries[1::2]))
+    digests = {all_filenames[rawid]: digest.hexdigest() for (rawid, digest) in mgf.digests.items()}
+    pending = {name: digest for (name, digest) in digests.items() if not searched.searched(name, digest)}
+    print(f"{len(digests) - len(pending)} of {len(digests)} rawfiles already searched.", file=sys.stderr, flush=True)
+    if len(pending) == len(digests):
+        search(seq_name + ".mgf", seq_name + ".txt", scan_count)
+        with open(seq_name + ".txt") as f:
+            (header, new_hits) = ledger.split_hits(f, pending)
+    else:
+        (header, new_hits) = ([], {})
+        searched_count = 0
+        if pending:
+            searched_count = spectra.filter_mgf(seq_name + ".mgf", seq_name + "_pending.mgf", pending)
+            search(seq_name + "_pending.mgf", seq_name + "_pending.txt", searched_count)
+            with open(seq_name + "_pending.txt") as f:
+                (header, new_hits) = ledger.split_hits(f, pending)
+            os.remove(seq_name + "_pending.mgf")
+            os.remove(seq_name + "_pending.txt")
+        # i.e. the .txt MSPepSearch would have produced for the whole MGF
+        with open(seq_name + ".txt", "w") as merged:
+            merged.writelines(header or searched.header())
+            for rawid in sorted(mgf.digests):
+                name = all_filenames[rawid]
+                merged.writelines(new_hits.get(name, []) if name in pending else searched.hits(name))
+    searched.record(header, new_hits, pending)
+    searched.close()
+else:
+    search(seq_name + ".mgf", seq_name + ".txt", scan_count)
+search_stop = time.time()
+metrics.record("search", search_stop - search_start, scans=searched_count)
+print(f"Library search of {searched_count} scans took {search_stop - search_start:.2f} seconds ({max(1, min(WORKERS, searched_count))} MSPepSearch processes).", file=sys.stderr, flush=True)
 print("", file=sys.stderr, flush=True)
 print("----------------", file=sys.stderr, flush=True)
 print("", file=sys.stderr, flush=True)
@@ -219,25 +260,17 @@ f = open(seq_name + ".txt")
 # RT_WINDOW is used to bracket the location of the MS2 ID -- it indirectly controls first phase of skeleton.
 
 if mspepsearch.platform == "win32":
-    print("Source\tMCRL_Score\tScore\tDot\tRevDot\tProb\tMetabolite\tInChIKey\tFormula\tIon Type\tRT (min)", file=out)
-    for line in f:
-        if line.startswith(">") or line.startswith("Unknown"):
-            continue
-        vals = line.strip().split("\t")
-        rt = float(vals[0].split(":")[1])
-        inchikey = ""
-        if len(vals) > 19:
-            inchikey = vals[19]
-        # 0.01 because python rounds 1.5 _down_... (!?!)
-        print(f"{vals[0]}\t{round(0.01 + (int(vals[9])+int(vals[11]))/2)}\t{vals[8]}\t{vals[9]}\t{vals[11]}\t{vals[10]}\t{vals[12]}\t{inchikey}\t{vals[14]}\t{vals[15]}\t{rt}", file=out)
+    headers = ["Source", "MCRL_Score", "Score", "Dot", "RevDot", "Prob", "Metabolite", "InChIKey", "Formula", "Ion Type", "RT (min)"]
 else:
-    print("Source\tMCRL_Score\tScore\tDot\tRevDot\tProb\tMetabolite\tFormula\tIon Type\tRT (min)", file=out)
-    for line in f:
-        if line.startswith(">") or line.startswith("Unknown"):
-            continue
-        vals = line.strip().split("\t")
-        rt = float(vals[0].split(":")[1])
-        # 0.01 because python rounds 1.5 _down_... (!?!)
-        print(f"{vals[0]}\t{round(0.01 + (int(vals[8])+int(vals[10]))/2)}\t{vals[7]}\t{vals[8]}\t{vals[10]}\t{vals[9]}\t{vals[11]}\t{vals[13]}\t{vals[14]}\t{rt}", file=out)
+    headers = ["Source", "MCRL_Score", "Score", "Dot", "RevDot", "Prob", "Metabolite", "Formula", "Ion Type", "RT (min)"]
+print("\t".join(headers), file=out)
+sidecar = hits.SidecarWriter(out.name, headers)
+for hit in hits.parse(f, mspepsearch.platform):
+    if mspepsearch.platform == "win32":
+        print(f"{hit.source}\t{hit.mcrl_score}\t{hit.score}\t{hit.dot}\t{hit.revdot}\t{hit.prob}\t{hit.metabolite}\t{hit.inchikey}\t{hit.formula}\t{hit.ion_type}\t{hit.rt}", file=out)
+    else:
+        print(f"{hit.source}\t{hit.mcrl_score}\t{hit.score}\t{hit.dot}\t{hit.revdot}\t{hit.prob}\t{hit.metabolite}\t{hit.formula}\t{hit.ion_type}\t{hit.rt}", file=out)
+    sidecar.add(hit)
 out.close()
 f.close()
+sidecar.close()
@@ -0,0 +1,69 @@
+# study: .sqlite3
+import sys
+import time
+import sqlite3
+import columnar
+import metrics
+
+start_time = time.time()
+
+__version__ = "0.1"
+
+#
+# Exports the peak tables of a study into a memory-mapped columnar store (see columnar.py), next to the .sqlite3 file.
+# Once the store exists (and as long as the peak tables are not modified), skeleton, ungrid, precursor_ion and
+# neutral_loss read their peaks from it instead of querying the study.
+#
+
+con = sqlite3.connect(study)
+cur = con.cursor()
+
+#
+# First, a sanity check (somewhat repetitive to later code, but this is temporary and will be removed when all unsafe raw2sql
+# generation will have been eliminated from the lab, along with any incorrect sqlite3 file...
+#
+
+sample_num = cur.execute(
+    "SELECT COUNT (DISTINCT name) from rawfile where ID > 0"
+).fetchone()[0]
+observed = cur.execute(
+    "SELECT COUNT (DISTINCT rawfile) from scans where rawfile > 0"
+).fetchone()[0]
+
+if sample_num != observed:
+    print("Sanity check failure: expected samples != observed files!!!", file=sys.stderr, flush=True)
+    sys.exit(-1)
+
+#
+# Second, load mass_translation and time_translation factors, if they are available...
+# TODO: Potentially factor this code out into a module that manages access to our db format. 
+#
+
+try:
+    mass_translation_factor = cur.execute(
+        "SELECT value from sequence where attribute = 'mass_translation_factor'"
+    ).fetchone()[0]
+    time_translation_factor = cur.execute(
+        "SELECT value from sequence where attribute = 'time_translation_factor'"
+    ).fetchone()[0]
+except:
+    mass_translation_factor = 10000  # 1 = 0.0001 Da
+    time_translation_factor = 1000   # 1 = 0.001 seconds
+
+
+def progress(table, count):
+    print(f"Exported {count} {table}...", file=sys.stderr, flush=True)
+
+
+meta = columnar.export(con, study, mass_translation_factor, time_translation_factor, progress)
+con.close()
+
+stop_time = time.time()
+metrics.record("export", stop_time - start_time)
+
+for (table, description) in meta["tables"].items():
+    print(f"{table}: {description['rows']} peaks.", file=sys.stderr, flush=True)
+print(
+    f"Exported {study} into {columnar.store_path(study)} in {stop_time - start_time :.2f} seconds.",
+    file=sys.stderr, flush=True
+)
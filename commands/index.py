@@ -0,0 +1,58 @@
+# study: .sqlite3
+import sys
+import time
+import sqlite3
+import indexes
+import columnar
+import metrics
+
+start_time = time.time()
+
+__version__ = "0.1"
+
+#
+# Builds (once) the covering indexes described in indexes.INDEXES and records them in the sequence table, which is
+# where ungrid, skeleton, precursor_ion etc. look for them before deciding how to query the peak tables.
+#
+
+con = sqlite3.connect(study)
+cur = con.cursor()
+
+#
+# First, a sanity check (somewhat repetitive to later code, but this is temporary and will be removed when all unsafe raw2sql
+# generation will have been eliminated from the lab, along with any incorrect sqlite3 file...
+#
+
+sample_num = cur.execute(
+    "SELECT COUNT (DISTINCT name) from rawfile where ID > 0"
+).fetchone()[0]
+observed = cur.execute(
+    "SELECT COUNT (DISTINCT rawfile) from scans where rawfile > 0"
+).fetchone()[0]
+
+if sample_num != observed:
+    print("Sanity check failure: expected samples != observed files!!!", file=sys.stderr, flush=True)
+    sys.exit(-1)
+
+# the columnar store (if any) only needs its record of the study updated, unless it was already out of date...
+store_meta = columnar.read_meta(study)
+store_current = store_meta is not None and columnar.is_current(study, store_meta)
+
+already_available = indexes.available(cur)
+for name in indexes.INDEXES:
+    if name in already_available:
+        print(f"{name} already available.", file=sys.stderr, flush=True)
+        continue
+    print(f"Building {name}...", file=sys.stderr, flush=True)
+    before = time.time()
+    indexes.build(con, name)
+    after = time.time()
+    metrics.record(name, after - before)
+    print(f"Built {name} in {after - before :.2f} seconds.", file=sys.stderr, flush=True)
+con.close()
+if store_current:
+    columnar.restamp(study)
+
+stop_time = time.time()
+
+print(f"Indexed {study} in {stop_time - start_time :.2f} seconds.", file=sys.stderr, flush=True)
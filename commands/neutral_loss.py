@@ -8,6 +8,8 @@ import sys
 import time
 import bisect
 import sqlite3
+import columnar
+import metrics
 
 start_time = time.time()
 
@@ -111,15 +113,35 @@ mz_low = round(mz_low * mass_translation_factor)
 mz_high = round(mz_high * mass_translation_factor)
 
 if abs_mz == "True":
-    PEAK_SQL = f"SELECT ms2_peaks.precursor, ms2_peaks.mz, ms2_peaks.rt, ms2_peaks.rawfile FROM ms2_peaks WHERE abs(ms2_peaks.precursor - ms2_peaks.mz) BETWEEN ? AND ? ORDER BY intensity DESC"
+    PEAK_SQL = f"SELECT ms2_peaks.precursor, ms2_peaks.mz, ms2_peaks.rt, ms2_peaks.rawfile FROM ms2_peaks WHERE abs(ms2_peaks.precursor - ms2_peaks.mz) BETWEEN ? AND ? ORDER BY intensity DESC, ms2_peaks.rowid"
 
 else:
-    PEAK_SQL = f"SELECT ms2_peaks.precursor, ms2_peaks.mz, ms2_peaks.rt, ms2_peaks.rawfile FROM ms2_peaks WHERE ms2_peaks.precursor - ms2_peaks.mz BETWEEN ? AND ? ORDER BY intensity DESC"
+    PEAK_SQL = f"SELECT ms2_peaks.precursor, ms2_peaks.mz, ms2_peaks.rt, ms2_peaks.rawfile FROM ms2_peaks WHERE ms2_peaks.precursor - ms2_peaks.mz BETWEEN ? AND ? ORDER BY intensity DESC, ms2_peaks.rowid"
+
+store = columnar.open_store(cur)
 
 print(f"Starting the neutral loss search...", file=sys.stderr, flush=True)
 start_query = time.time()
-all_peaks = list(cur.execute(PEAK_SQL, (mz_low, mz_high)))
+if store:
+    # NOTE: no index helps here (the loss is a difference of two columns), so this is a plain pass over the columns.
+    ms2 = store["ms2_peaks"]
+    if abs_mz == "True":
+        loss_offsets = [
+            offset
+            for (offset, precursor, mz) in zip(range(len(ms2)), ms2.precursor, ms2.mz)
+            if mz_low <= abs(precursor - mz) <= mz_high
+        ]
+    else:
+        loss_offsets = [
+            offset
+            for (offset, precursor, mz) in zip(range(len(ms2)), ms2.precursor, ms2.mz)
+            if mz_low <= precursor - mz <= mz_high
+        ]
+    all_peaks = list(ms2.fetch(ms2.most_intense_first(loss_offsets), "precursor", "mz", "rt", "rawfile"))
+else:
+    all_peaks = list(cur.execute(PEAK_SQL, (mz_low, mz_high)))
 stop_query = time.time()
+metrics.record("query", stop_query - start_query, peaks=len(all_peaks))
 
 print(
     f"Finished precursor-query in {stop_query-start_query:.2f} seconds.",
@@ -164,6 +186,7 @@ for (precursor, mz, rt, rfile) in all_peaks:
         bisect.insort(slots, potential_slot)
 
 stop_process = time.time()
+metrics.record("slotting", stop_process - start_process, peaks=len(all_peaks), slots=len(slots))
 print(
     f"Finished processing {len(all_peaks)} neutral losses into {len(slots)} potential parents in {stop_process-start_process:.2f} seconds.",
     file=sys.stderr, flush=True
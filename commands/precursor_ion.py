@@ -7,6 +7,9 @@ import sys
 import time
 import bisect
 import sqlite3
+import indexes
+import columnar
+import metrics
 
 start_time = time.time()
 
@@ -108,12 +111,21 @@ else:
 mz_low = round(mz_low * mass_translation_factor)
 mz_high = round(mz_high * mass_translation_factor)
 
-PEAK_SQL = f"SELECT ms2_peaks.precursor, ms2_peaks.mz, ms2_peaks.rt, ms2_peaks.rawfile FROM ms2_peaks WHERE ms2_peaks.rawfile > 0 AND ms2_peaks.mz BETWEEN ? AND ? ORDER BY intensity DESC"
+PEAK_SQL = f"SELECT ms2_peaks.precursor, ms2_peaks.mz, ms2_peaks.rt, ms2_peaks.rawfile FROM ms2_peaks{indexes.indexed_by(cur, 'ms2_peaks_mz')} WHERE ms2_peaks.rawfile > 0 AND ms2_peaks.mz BETWEEN ? AND ? ORDER BY intensity DESC, ms2_peaks.rowid"
+
+store = columnar.open_store(cur)
 
 print(f"Starting the precursor ion search...", file=sys.stderr, flush=True)
 start_query = time.time()
-all_frags = list(cur.execute(PEAK_SQL, (mz_low, mz_high)))
+if store:
+    ms2 = store["ms2_peaks"]
+    (first, last) = ms2.mz_range(mz_low, mz_high)
+    frag_offsets = ms2.most_intense_first(offset for offset in range(first, last) if ms2.rawfile[offset] > 0)
+    all_frags = list(ms2.fetch(frag_offsets, "precursor", "mz", "rt", "rawfile"))
+else:
+    all_frags = list(cur.execute(PEAK_SQL, (mz_low, mz_high)))
 stop_query = time.time()
+metrics.record("query", stop_query - start_query, peaks=len(all_frags))
 
 print(
     f"Finished precursor-query in {stop_query-start_query:.2f} seconds.",
@@ -156,6 +168,7 @@ for (precursor, mz, rt, rfile) in all_frags:
         bisect.insort(slots, potential_slot)
 
 stop_process = time.time()
+metrics.record("slotting", stop_process - start_process, peaks=len(all_frags), slots=len(slots))
 print(
     f"Finished processing {len(all_frags)} peaks into {len(slots)} potential parents in {stop_process-start_process:.2f} seconds.",
     file=sys.stderr, flush=True
@@ -12,9 +12,12 @@
 import sys
 import time
 import operator
-import actions
-import nist_ion_descriptions
+import bisect
+import math
+import parsers
 import columns
+import hits
+import metrics
 
 start_time = time.time()
 
@@ -22,94 +25,96 @@ __version__ = "0.2"
 
 HeaderName = {"dot": "Dot", "revdot": "RevDot", "mcrl_score": "MCRL_Score", "score": "Score", "prob": "Prob", "percentile": "Percentile"}
 
-(rows, unmatched, unexpected) = columns.loader(
-    unrefined,
-    {
-        "Metabolite": {
-            "field": "metabolite",
-            "constructor": str,
-            "required": True,
-            "description": "Metabolite name.",
-        },
-        "InChIKey": {
-            "field": "inchikey",
-            "constructor": str,
-            "required": False,
-            "description": "InChIKey.",
-        },
-        "Ion Type": {
-            "field": "ion_type",
-            "constructor": str,
-            "required": True,
-            "description": "Description of ion type using the grammar described in parsers/nist_ion_descriptions.py.",
-        },
-        "MCRL_Score": {
-            "field": "mcrl_score",
-            "constructor": int,
-            "required": False,
-            "description": "MCRL-defined score associated with identification.",
-        },
-        "Score": {
-            "field": "score",
-            "constructor": int,
-            "required": False,
-            "description": "Score associated with identification.",
-        },
-        "Dot": {
-            "field": "dot",
-            "constructor": int,
-            "required": False,
-            "description": "Dot product based score associated with identification.",
-        },
-        "RevDot": {
-            "field": "revdot",
-            "constructor": int,
-            "required": False,
-            "description": "Reverse dot product based score associated with identification.",
-        },
-        "Prob": {
-            "field": "prob",
-            "constructor": float,
-            "required": False,
-            "description": "Probability associated with identification.",
-        },
-        "Source": {
-            "field": "source",
-            "constructor": str,
-            "required": False,
-            "description": "Scan identifier for the scan that led to the identification.",
-        },
-        "Formula": {
-            "field": "formula",
-            "constructor": str,
-            "required": True,
-            "description": "Either the Chemical Formula or the m/z of the feature identified."
-        },
-        "Percentile": {
-            "field": "percentile",
-            "constructor": float,
-            "required": False,
-            "description": "Highest intensity percentile of feature observation across the study/batch (higher is more intense)."
-
-        }, 
-        "RT (min)": {
-            "field": "rt",
-            "constructor": float,
-            "required": True,
-            "description": "RT (in minutes).",
-        },
+header_description = {
+    "Metabolite": {
+        "field": "metabolite",
+        "constructor": str,
+        "required": True,
+        "description": "Metabolite name.",
     },
-)
+    "InChIKey": {
+        "field": "inchikey",
+        "constructor": str,
+        "required": False,
+        "description": "InChIKey.",
+    },
+    "Ion Type": {
+        "field": "ion_type",
+        "constructor": str,
+        "required": True,
+        "description": "Description of ion type using the grammar described in parsers/nist_ion_descriptions.py.",
+    },
+    "MCRL_Score": {
+        "field": "mcrl_score",
+        "constructor": int,
+        "required": False,
+        "description": "MCRL-defined score associated with identification.",
+    },
+    "Score": {
+        "field": "score",
+        "constructor": int,
+        "required": False,
+        "description": "Score associated with identification.",
+    },
+    "Dot": {
+        "field": "dot",
+        "constructor": int,
+        "required": False,
+        "description": "Dot product based score associated with identification.",
+    },
+    "RevDot": {
+        "field": "revdot",
+        "constructor": int,
+        "required": False,
+        "description": "Reverse dot product based score associated with identification.",
+    },
+    "Prob": {
+        "field": "prob",
+        "constructor": float,
+        "required": False,
+        "description": "Probability associated with identification.",
+    },
+    "Source": {
+        "field": "source",
+        "constructor": str,
+        "required": False,
+        "description": "Scan identifier for the scan that led to the identification.",
+    },
+    "Formula": {
+        "field": "formula",
+        "constructor": str,
+        "required": True,
+        "description": "Either the Chemical Formula or the m/z of the feature identified."
+    },
+    "Percentile": {
+        "field": "percentile",
+        "constructor": float,
+        "required": False,
+        "description": "Highest intensity percentile of feature observation across the study/batch (higher is more intense)."
+
+    }, 
+    "RT (min)": {
+        "field": "rt",
+        "constructor": float,
+        "required": True,
+        "description": "RT (in minutes).",
+    },
+}
 
+# dewey leaves a typed (binary) copy of its .features next to them, which is much faster to load...
+loaded = hits.load(unrefined, header_description)
+if loaded is None:
+    loaded = columns.load_columns(unrefined, header_description)
+(table, unmatched, unexpected) = loaded
+rows = table.rows()
 
-PPM = PPM / 1000000.0
 
-out = open(__file__[:-3] + ".features", "w")
+PPM = PPM / 1000000.0
 
 if "inchikey" in unmatched:
-    out_headers = "\t".join(["Metabolite", "Ion Type", "Formula", "RT (min)", HeaderName[filter_by]])
+    out_columns = [("Metabolite", "%s"), ("Ion Type", "%s"), ("Formula", "%s"), ("RT (min)", "%.2f"), (HeaderName[filter_by], "%s")]
 else:
-    out_headers = "\t".join(["Metabolite", "InChIKey", "Ion Type", "Formula", "RT (min)", HeaderName[filter_by]])
+    out_columns = [("Metabolite", "%s"), ("InChIKey", "%s"), ("Ion Type", "%s"), ("Formula", "%s"), ("RT (min)", "%.2f"), (HeaderName[filter_by], "%s")]
 
 rows.sort(key=operator.attrgetter(filter_by), reverse=True)
 
@@ -117,6 +122,49 @@ if equivalence_by == "mzrt":
     for row in rows:
         row.formula = float(row.formula)
 
+# Every accepted identification is indexed by what makes two identifications equivalent (besides their RT, which is
+# looked up in a sorted list per key), so that checking a row is a matter of a few lookups instead of a comparison
+# with every identification accepted so far. The outcome (i.e. which rows are accepted, and in which order) is that
+# of comparing every row with every accepted identification.
+RT_SLACK = 1e-6  # looking a little wider than RT_TOL, every candidate is then checked with the exact comparison
+MZ_BUCKET = max(PPM * 1000.0, 0.0001)  # i.e. the m/z tolerance around m/z 1000
+
+by_key = {}  # (inchikey or inchik, ion type) -> sorted RTs of the accepted identifications with an inchikey
+by_name = {}  # (metabolite, ion type) -> sorted RTs of the accepted identifications (without an inchikey)
+by_mz = {}  # m/z bucket -> sorted (RT, m/z) of the accepted identifications
+
+
+def rt_match(rts, rt):
+    i = bisect.bisect_left(rts, rt - RT_TOL - RT_SLACK)
+    while i < len(rts) and rts[i] <= rt + RT_TOL + RT_SLACK:
+        if abs(rt - rts[i]) <= RT_TOL:
+            return True
+        i += 1
+    return False
+
+
+def mzrt_match(mz, rt):
+    if PPM >= 0.5:
+        candidates = by_mz.values()  # i.e. every accepted identification...
+    else:
+        reach = abs(mz) * PPM / (1.0 - PPM) * (1.0 + 1e-9) + 1e-9
+        candidates = [by_mz.get(b, ()) for b in range(math.floor((mz - reach) / MZ_BUCKET), math.floor((mz + reach) / MZ_BUCKET) + 1)]
+    for entries in candidates:
+        i = bisect.bisect_left(entries, (rt - RT_TOL - RT_SLACK,))
+        while i < len(entries) and entries[i][0] <= rt + RT_TOL + RT_SLACK:
+            (existing_rt, existing_mz) = entries[i]
+            if abs((existing_mz - mz)/existing_mz) <= PPM and abs(rt - existing_rt) <= RT_TOL:
+                return True
+            i += 1
+    return False
+
+
+def key_of(row):
+    if equivalence_by == "inchik":
+        return row.inchikey[:14]
+    return row.inchikey
+
+
 ids = []
 for row in rows:
     if MatchPolarity == "True":
@@ -128,46 +176,31 @@ for row in rows:
 
     if row.ion_type:
         try:
-            parsed = nist_ion_descriptions.parse(row.ion_type, actions=actions.Actions())
-        except nist_ion_descriptions.ParseError:
+            parsers.parse_ion_type(row.ion_type)
+        except parsers.ParseError:
             continue
 
-    found_equivalent = False
-    for existing in ids:
-        if equivalence_by == "inchikey":  # existing entries without an inchikey are considered distinct...
-            if existing.inchikey:
-                if (row.inchikey == existing.inchikey) and (row.ion_type == existing.ion_type):
-                    if abs(row.rt - existing.rt) <= RT_TOL:
-                        found_equivalent = True
-                        break
-            else:  # matching can still occur by name when no inchikey is present in both entries...
-                if (not existing.inchikey) and (row.metabolite == existing.metabolite) and (row.ion_type == existing.ion_type):
-                    if abs(row.rt - existing.rt) <= RT_TOL:
-                        found_equivalent = True
-                        break                    
-        if equivalence_by == "inchik":  # existing entries without an inchikey are considered distinct...
-            if existing.inchikey:
-                if (row.inchikey[:14] == existing.inchikey[:14]) and (row.ion_type == existing.ion_type):
-                    if abs(row.rt - existing.rt) <= RT_TOL:
-                        found_equivalent = True
-                        break
-            else:  # matching can still occur by name when no inchikey is present in both entries...
-                if (not existing.inchikey) and (row.metabolite == existing.metabolite) and (row.ion_type == existing.ion_type):
-                    if abs(row.rt - existing.rt) <= RT_TOL:
-                        found_equivalent = True
-                        break                    
-        if equivalence_by == "name":
-            if (row.metabolite == existing.metabolite) and (row.ion_type == existing.ion_type):
-                if abs(row.rt - existing.rt) <= RT_TOL:
-                    found_equivalent = True
-                    break
-        if equivalence_by == "mzrt":
-            if abs((existing.formula - row.formula)/existing.formula) <= PPM:
-                if abs(row.rt - existing.rt) <= RT_TOL:
-                    found_equivalent = True
-                    break
-    if not found_equivalent:
-        ids.append(row)
+    if equivalence_by == "inchikey" or equivalence_by == "inchik":
+        # entries with an inchikey are matched by (the first 14 characters of) their inchikey, entries without one
+        # (which are considered distinct from the former) can still be matched by name...
+        key = key_of(row)
+        if key and rt_match(by_key.get((key, row.ion_type), ()), row.rt):
+            continue
+        if rt_match(by_name.get((row.metabolite, row.ion_type), ()), row.rt):
+            continue
+        if row.inchikey:
+            bisect.insort(by_key.setdefault((key, row.ion_type), []), row.rt)
+        else:
+            bisect.insort(by_name.setdefault((row.metabolite, row.ion_type), []), row.rt)
+    if equivalence_by == "name":
+        if rt_match(by_name.get((row.metabolite, row.ion_type), ()), row.rt):
+            continue
+        bisect.insort(by_name.setdefault((row.metabolite, row.ion_type), []), row.rt)
+    if equivalence_by == "mzrt":
+        if mzrt_match(row.formula, row.rt):
+            continue
+        bisect.insort(by_mz.setdefault(math.floor(row.formula / MZ_BUCKET), []), (row.rt, row.formula))
+    ids.append(row)
 
 
 if equivalence_by == "mzrt":
@@ -176,15 +209,17 @@ if equivalence_by == "mzrt":
 
 extract_score = operator.attrgetter(filter_by)
 
+if "inchikey" in unmatched:
+    def out_values(row):
+        return (row.metabolite, row.ion_type, row.formula, row.rt, extract_score(row))
+else:
+    def out_values(row):
+        return (row.metabolite, row.inchikey, row.ion_type, row.formula, row.rt, extract_score(row))
+
 if FDR == "False":
-    print(out_headers, file=out)
-    reported_idrts = 0 
-    for row in ids:
-        reported_idrts += 1
-        if "inchikey" in unmatched:
-            print(f"{row.metabolite}\t{row.ion_type}\t{row.formula}\t{row.rt:0.2f}\t{extract_score(row)}", file=out)
-        else:
-            print(f"{row.metabolite}\t{row.inchikey}\t{row.ion_type}\t{row.formula}\t{row.rt:0.2f}\t{extract_score(row)}", file=out)
+    out = columns.Writer(__file__[:-3] + ".features", out_columns)
+    out.write_rows(out_values(row) for row in ids)
+    reported_idrts = out.row_count
     out.close()
 else:
     detections = []
@@ -195,21 +230,20 @@ else:
         if detections[i][0].metabolite.startswith("Decoy_"):
             decounter += 1
         detections[i][1] = decounter
-    print(out_headers + "\tFDR", file=out)
+    out = columns.Writer(__file__[:-3] + ".features", out_columns + [("FDR", "%.0f")])
     detections[-1][1] = detections[-1][1] / max(detections[-1][1], (len(detections) - detections[-1][1]))
     for i in range(len(detections)-2, 0, -1):
         detections[i][1] = min(detections[i+1][1], detections[i][1] / max(detections[i][1], (i+1) - detections[i][1]))
-    reported_idrts = 0
+    reported = []
     for entry in detections:
         if Keep_Decoy_Hits == "False" and entry[0].metabolite.startswith("Decoy_"):
             continue
         if entry[1] <= MAX_FDR / 100:  # MAX_FDR is in % now...
-            reported_idrts += 1
-            row = entry[0]
-            if "inchikey" in unmatched:
-                print(f"{row.metabolite}\t{row.ion_type}\t{row.formula}\t{row.rt:0.2f}\t{extract_score(row)}\t{100*entry[1]:.0f}", file=out)
-            else:
-                print(f"{row.metabolite}\t{row.inchikey}\t{row.ion_type}\t{row.formula}\t{row.rt:0.2f}\t{extract_score(row)}\t{100*entry[1]:.0f}", file=out)
+            reported.append(out_values(entry[0]) + (100*entry[1],))
+    out.write_rows(reported)
+    reported_idrts = out.row_count
+    out.close()
 stop_time = time.time()
+metrics.record("refine", stop_time - start_time, rows=len(rows), reported=reported_idrts)
 
 print(f"\nreduced {len(rows)} rows to {reported_idrts} ID+RT combinations in {stop_time - start_time :.2f} seconds.", file=sys.stderr, flush=True)
@@ -1,10 +1,13 @@
 # study: .sqlite3
+# MGF: False True
 import sys
 import os
 import time
 import subprocess
 import sqlite3
+import spectra
 import lib2nist
+import metrics
 
 start_time = time.time()
 
@@ -60,7 +63,6 @@ except:
 
 FILE_SQL = """SELECT rawfile.id, rawfile.name FROM rawfile WHERE rawfile.id > 0 ORDER BY rawfile.id ASC"""
 SCAN_SQL = """SELECT scans.scan_ID, scans.rt, scans.precursor, scans.scan_type FROM scans WHERE scans.rawfile = ? ORDER BY scans.scan_ID ASC"""
-PEAK_SQL = """SELECT ms2_peaks.rawfile, ms2_peaks.rt, ms2_peaks.mz, ms2_peaks.intensity FROM ms2_peaks WHERE ms2_peaks.rawfile > 0 ORDER BY ms2_peaks.rawfile ASC, ms2_peaks.rt ASC, ms2_peaks.mz ASC"""
 
 all_filenames = {}
 for x in cur.execute(FILE_SQL):
@@ -85,110 +87,36 @@ for (rawid, fname) in all_filenames.items():
             scans[x[1]] = [x[0], x[2], prev_ms1]
     all_scans[rawid] = scans
 scan_loader_stop = time.time()
+metrics.record("scan_loading", scan_loader_stop - scan_loader_start, scans=scan_loader_scan_counter)
 print(f"{scan_loader_scan_counter} scans loaded in {scan_loader_stop - scan_loader_start:.2f} seconds", file=sys.stderr, flush=True)
 
 #
-# MGF Generation and Search
+# MSP Generation (and optionally MGF, in the same pass) and Library Building
 #
 
-mgf_make_start = time.time()
+msp_make_start = time.time()
 
-mgf = open(seq_name + ".mgf", 'w')
+msp_name = f"{seq_name + '.MSP'}"
+writers = [spectra.MspWriter(msp_name, all_filenames, all_scans, mass_translation_factor, time_translation_factor)]
+if MGF == "True":
+    writers.append(spectra.MgfWriter(seq_name + ".mgf", all_filenames, all_scans, mass_translation_factor, time_translation_factor))
 
 start_query = time.time()
-prev_rt = -1
-prev_rawid = None
-scan_count = 0
-peak_count = 0
-peaks = []  # Technically this gets taken care of in the loop, but still, defensive programming etc...
-peak_counter = 0  # TODO: duplicate counter used purely for visual feedback, should be removed.
-for (rawid, rt, mz, intensity) in cur.execute(PEAK_SQL):
-    # NOTE: rt and mz are still raw integers unmodified by time and mass factors!!!
-    peak_counter += 1
-    if not (peak_counter % 100000):
-        print(f"peaks processed = {peak_counter} ", flush=True)
-    if rawid != prev_rawid or rt != prev_rt:
-        # Finalize Scan...
-        if scan_count > 0:
-            for (m, i) in peaks:
-                print(f"{m} {i}", file=mgf)
-            print("END IONS\n", file=mgf)
-        peaks = []
-        prev_rt = rt
-        prev_rawid = rawid
-        scan_count += 1
-        pepmass = all_scans[rawid][rt][1]
-        print("BEGIN IONS", file=mgf)
-        if pepmass > 0:
-            print(f"TITLE={all_filenames[rawid]}.{all_scans[rawid][rt][0]}.+", file=mgf)
-            print("CHARGE=127+", file=mgf)
-        else:
-            print(f"TITLE={all_filenames[rawid]}.{all_scans[rawid][rt][0]}.-", file=mgf)
-            print("CHARGE=128-", file=mgf)
-        print(f"RTINSECONDS={float(rt / time_translation_factor)}", file=mgf)
-        if pepmass > 0:
-            print(f"PEPMASS={float(pepmass / mass_translation_factor)}", file=mgf)
-        else:
-            print(f"PEPMASS={-1 * float(pepmass / mass_translation_factor)}", file=mgf)
-    peak_count += 1
-    if mz < 0:
-        peaks = [(float( (-mz) / mass_translation_factor), intensity)] + peaks
-    else:
-        peaks.append((float(mz / mass_translation_factor), intensity))
-# Finalize Last Scan...
-if scan_count > 0:
-    for (m, i) in peaks:
-        print(f"{m} {i}", file=mgf)
-    print("END IONS\n", file=mgf)
+spectra.write_study(cur, writers)
 stop_query = time.time()
-mgf.close()
-
-mgf_make_stop = time.time()
-print(f"MGF created in {mgf_make_stop - mgf_make_start:.2f} seconds.", file=sys.stderr, flush=True)
-print(f"sql2mgf phase processed {peak_count} peaks and {scan_count} scans from {len(all_filenames)} files in {mgf_make_stop - start_time :.2f} seconds.", file=sys.stderr, flush=True)
+for writer in writers:
+    writer.close()
+    writer.report()
+scan_count = writers[0].scan_count
+peak_count = writers[0].peak_count
+
+msp_make_stop = time.time()
+metrics.record("msp", msp_make_stop - msp_make_start, scans=scan_count, peaks=peak_count)
+print(f"MSP created in {msp_make_stop - msp_make_start:.2f} seconds.", file=sys.stderr, flush=True)
+print(f"sql2msp phase processed {peak_count} peaks and {scan_count} scans from {len(all_filenames)} files in {msp_make_stop - start_time :.2f} seconds.", file=sys.stderr, flush=True)
 print("", file=sys.stderr, flush=True)
 print("----------------", file=sys.stderr, flush=True)
 
-
-msp_name = f"{seq_name + '.MSP'}"
-msp = open(msp_name, 'w')
-name = None
-precursor = None
-current_id = 1
-peaks = []
-with open(seq_name + ".mgf") as mgf:
-    for line in mgf:
-        if line.startswith("END IONS"):
-            print(f"Name: {name}", file=msp)
-            print(f"PrecursorMZ: {precursor}", file=msp)
-            print(f"ID: {current_id}", file=msp)
-            print(f"Num peaks: {len(peaks)}", file=msp)
-            for peak in peaks:
-                print(peak, file=msp)
-            print("", file=msp)
-            name = None
-            precursor = None
-            current_id += 1
-            peaks = []
-            if not current_id % 65536:
-                # This allows us to use the default KEEP_IDS setting in LIB2NIST and nevertheless
-                # circumvent its known bug regarding IDS at multiples of 65536.
-                current_id += 1
-            continue
-        if line.startswith("TITLE="):
-            name = line.strip()[7:]
-            continue
-        if line.startswith("RTINSECONDS="):
-            name += "." + (line.strip()[12:].replace(".",""))
-            continue
-        if line.startswith("PEPMASS="):
-            precursor = line.strip()[8:]
-            continue
-        if line[0] in "0123456789":
-            peaks.append(line.strip())
-            continue
-msp.close()
-
 if lib2nist.platform == "win32":
     # print([lib2nist.path, msp_name, f"{os.getcwd()}\\", "/AccuratePeakMZ", "/MsmsOnly:Y"])
     # print(f"{lib2nist.path} {msp_name} {os.getcwd()}\\ /AccuratePeakMZ /MsmsOnly:Y")
@@ -0,0 +1,115 @@
+import os
+import shutil
+import sqlite3
+import hashlib
+
+#
+# Content fingerprints of command input files, and a content-addressed index of finished command runs.
+#
+# Digests are remembered (in a small sqlite index, under ~/.plz by default or wherever PLZ_CACHE points to) along with
+# the size, modification time and inode of the file they were computed from, so that a (multi GB) study only gets
+# hashed again once it has actually changed. The same index records where every command run finished, so that an
+# identical run (same command, same arguments, same input contents) can reuse the outputs of an earlier one, even
+# when it took place in another directory. Only the <command>_<hash> files of a run get copied, hence plz only reuses
+# the runs of commands which declare their outputs (# output: in the template) and do not opt out (# reusable: False,
+# e.g. dewey, whose ledger lives next to the study).
+#
+# Digests are always md5: they end up in the code of commands (hence in the <command>_<hash> names of their files),
+# which must not depend on what happens to be installed for runs to be recognised as identical across machines.
+#
+
+CHUNK_SIZE = 8 * 1024 * 1024
+
+FILES_TABLE_SQL = """CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, inode INTEGER, algorithm TEXT, digest TEXT)"""
+RUNS_TABLE_SQL = """CREATE TABLE IF NOT EXISTS runs (name TEXT, directory TEXT, PRIMARY KEY (name, directory))"""
+LOOKUP_FILE_SQL = """SELECT digest FROM files WHERE path = ? AND size = ? AND mtime = ? AND inode = ? AND algorithm = ?"""
+RECORD_FILE_SQL = """INSERT OR REPLACE INTO files (path, size, mtime, inode, algorithm, digest) VALUES (?, ?, ?, ?, ?, ?)"""
+LOOKUP_RUNS_SQL = """SELECT directory FROM runs WHERE name = ?"""
+RECORD_RUN_SQL = """INSERT OR REPLACE INTO runs (name, directory) VALUES (?, ?)"""
+FORGET_RUN_SQL = """DELETE FROM runs WHERE name = ? AND directory = ?"""
+
+ALGORITHM = "md5"
+
+_index = None
+
+
+def index():
+    # the (lazily opened) connection to the index, or None when it cannot be opened (e.g. read-only home directory)
+    global _index
+    if _index is None:
+        directory = os.environ.get("PLZ_CACHE", os.path.join(os.path.expanduser("~"), ".plz"))
+        try:
+            os.makedirs(directory, exist_ok=True)
+            _index = sqlite3.connect(os.path.join(directory, "cache.sqlite3"), timeout=60)
+            _index.execute(FILES_TABLE_SQL)
+            _index.execute(RUNS_TABLE_SQL)
+            _index.commit()
+        except (OSError, sqlite3.Error):
+            _index = False
+    return _index or None
+
+
+def digest(filename):
+    # (algorithm, hex digest) of the contents of filename, computed in chunks, or taken from the index when the file
+    # has not changed (same size, modification time and inode) since it was last digested
+    path = os.path.abspath(filename)
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime_ns, stat.st_ino, ALGORITHM)
+    con = index()
+    if con:
+        known = con.execute(LOOKUP_FILE_SQL, key).fetchone()
+        if known:
+            return (ALGORITHM, known[0])
+    hasher = hashlib.md5()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            hasher.update(chunk)
+    hexdigest = hasher.hexdigest()
+    if con:
+        try:
+            con.execute(RECORD_FILE_SQL, key + (hexdigest,))
+            con.commit()
+        except sqlite3.Error:
+            pass  # the index is only a cache, e.g. another plz may be holding it locked for too long
+    return (ALGORITHM, hexdigest)
+
+
+def record_run(cmd_file_name):
+    # remembers that cmd_file_name (<command>_<hash>.py) finished in the current directory
+    con = index()
+    if con:
+        try:
+            con.execute(RECORD_RUN_SQL, (cmd_file_name, os.getcwd()))
+            con.commit()
+        except sqlite3.Error:
+            pass
+
+
+def reuse_run(cmd_file_name):
+    # Copies the outputs (i.e. every file named after cmd_file_name, .py and .py.done included) of an identical run
+    # which finished in another directory into the current one, and returns that directory (or None if there is none)
+    con = index()
+    if not con:
+        return None
+    prefix = cmd_file_name[:(-3)]
+    here = os.path.realpath(os.getcwd())
+    for (directory,) in con.execute(LOOKUP_RUNS_SQL, (cmd_file_name,)).fetchall():
+        if os.path.realpath(directory) == here:
+            continue
+        if not os.path.exists(os.path.join(directory, cmd_file_name + ".done")):
+            try:
+                con.execute(FORGET_RUN_SQL, (cmd_file_name, directory))
+                con.commit()
+            except sqlite3.Error:
+                pass
+            continue
+        outputs = [name for name in os.listdir(directory) if name.startswith(prefix)]
+        # .done goes last, so that an interrupted copy is simply not considered finished
+        outputs.sort(key=lambda name: name.endswith(".done"))
+        for name in outputs:
+            shutil.copyfile(os.path.join(directory, name), name)
+        return directory
+    return None
@@ -0,0 +1,181 @@
+import sys
+import json
+import collections
+from array import array
+import columns
+import fingerprints
+
+#
+# MSPepSearch hit tables (its /OUTTAB .txt output) and their typed, binary copy (the .hits sidecar of dewey .features).
+#
+# Hit columns are found by name in the header line MSPepSearch writes (the one starting with Unknown), falling back on
+# the historical offsets (which differ between the win32 and the linux MSPepSearch) when there is no such header or
+# when it lacks some of the columns dewey needs.
+#
+# The sidecar holds the same rows as the .features file it was written with, one typed column per .features column,
+# along with the fingerprint of that .features file: load() only uses it as long as the .features file is unchanged.
+#
+
+Hit = collections.namedtuple("Hit", "source mcrl_score score dot revdot prob metabolite inchikey formula ion_type rt")
+
+COLUMNS = {
+    "score": ("Score",),
+    "dot": ("Dot",),
+    "revdot": ("RevDot",),
+    "prob": ("Prob",),
+    "metabolite": ("Name",),
+    "formula": ("Formula",),
+    "ion_type": ("PrecType", "Prec.Type"),
+}
+OPTIONAL_COLUMNS = {
+    "inchikey": ("InChIKey",),
+}
+LEGACY_OFFSETS = {
+    "win32": {"score": 8, "dot": 9, "prob": 10, "revdot": 11, "metabolite": 12, "formula": 14, "ion_type": 15, "inchikey": 19},
+    "linux": {"score": 7, "dot": 8, "prob": 9, "revdot": 10, "metabolite": 11, "formula": 13, "ion_type": 14},
+}
+
+# .features column: (Hit field, sidecar type), where q is an integer, d a float and s a string column
+FEATURES_COLUMNS = {
+    "Source": ("source", "s"),
+    "MCRL_Score": ("mcrl_score", "q"),
+    "Score": ("score", "q"),
+    "Dot": ("dot", "q"),
+    "RevDot": ("revdot", "q"),
+    "Prob": ("prob", "d"),
+    "Metabolite": ("metabolite", "s"),
+    "InChIKey": ("inchikey", "s"),
+    "Formula": ("formula", "s"),
+    "Ion Type": ("ion_type", "s"),
+    "RT (min)": ("rt", "d"),
+}
+TYPES = {"q": int, "d": float, "s": str}
+
+
+def is_header(line):
+    # MSPepSearch header lines, as opposed to hit lines
+    return line.startswith(">") or line.startswith("Unknown")
+
+
+def _offsets(header, platform):
+    legacy = LEGACY_OFFSETS["win32" if platform == "win32" else "linux"]
+    if header is None:
+        return legacy
+    names = header.strip().split("\t")
+    offsets = {}
+    for (field, candidates) in list(COLUMNS.items()) + list(OPTIONAL_COLUMNS.items()):
+        for (offset, name) in enumerate(names):
+            if name in candidates:
+                offsets[field] = offset
+                break
+    if any(field not in offsets for field in COLUMNS):
+        return legacy
+    return offsets
+
+
+def parse(lines, platform):
+    # the Hit of every hit line of an MSPepSearch .txt output (the prob of which is kept as written, as dewey copies it)
+    offsets = _offsets(None, platform)
+    for line in lines:
+        if is_header(line):
+            if line.startswith("Unknown"):
+                offsets = _offsets(line, platform)
+            continue
+        vals = line.strip().split("\t")
+        dot = int(vals[offsets["dot"]])
+        revdot = int(vals[offsets["revdot"]])
+        inchikey = ""
+        if "inchikey" in offsets and len(vals) > offsets["inchikey"]:
+            inchikey = vals[offsets["inchikey"]]
+        yield Hit(
+            vals[0],
+            round(0.01 + (dot + revdot) / 2),  # 0.01 because python rounds 1.5 _down_... (!?!)
+            int(vals[offsets["score"]]),
+            dot,
+            revdot,
+            vals[offsets["prob"]],
+            vals[offsets["metabolite"]],
+            inchikey,
+            vals[offsets["formula"]],
+            vals[offsets["ion_type"]],
+            float(vals[0].split(":")[1]),
+        )
+
+
+def sidecar_path(features_filename):
+    if features_filename.endswith(".features"):
+        features_filename = features_filename[:(-9)]
+    return features_filename + ".hits"
+
+
+class SidecarWriter:
+    def __init__(self, features_filename, headers):
+        # headers are the columns of the .features file (see FEATURES_COLUMNS)
+        self.features_filename = features_filename
+        self.headers = headers
+        self.columns = []
+        for header in headers:
+            (field, kind) = FEATURES_COLUMNS[header]
+            self.columns.append((field, kind, [] if kind == "s" else array(kind)))
+        self.rows = 0
+
+    def add(self, hit):
+        for (field, kind, values) in self.columns:
+            value = getattr(hit, field)
+            values.append(float(value) if kind == "d" else value)
+        self.rows += 1
+
+    def close(self):
+        # writes the sidecar, which is only valid for the .features file as it is now (i.e. write that one first)
+        meta = {
+            "byteorder": sys.byteorder,
+            "features": list(fingerprints.digest(self.features_filename)),
+            "rows": self.rows,
+            "columns": [],
+        }
+        blobs = []
+        for (header, (field, kind, values)) in zip(self.headers, self.columns):
+            if kind == "s":
+                blob = "\n".join(values).encode()
+            else:
+                blob = values.tobytes()
+            meta["columns"].append([header, kind, len(blob)])
+            blobs.append(blob)
+        with open(sidecar_path(self.features_filename), "wb") as out:
+            out.write(json.dumps(meta).encode() + b"\n")
+            for blob in blobs:
+                out.write(blob)
+
+
+def load(features_filename, header_description):
+    # What columns.load_columns(features_filename, header_description) would return, straight from the sidecar of the
+    # .features file, or None when there is no (valid) sidecar or it does not fit the header description
+    try:
+        with open(sidecar_path(features_filename), "rb") as f:
+            meta = json.loads(f.readline())
+            data = f.read()
+    except (OSError, ValueError):
+        return None
+    if meta.get("byteorder") != sys.byteorder or tuple(meta.get("features", ())) != fingerprints.digest(features_filename):
+        return None
+    table = {}
+    offset = 0
+    for (header, kind, size) in meta["columns"]:
+        description = header_description.get(header)
+        if description is None or description["constructor"] is not TYPES[kind]:
+            return None
+        blob = data[offset:(offset + size)]
+        offset += size
+        if kind == "s":
+            column = blob.decode().split("\n") if meta["rows"] else []
+        else:
+            column = array(kind)
+            column.frombytes(blob)
+        table[description["field"]] = column
+    unmatched = []
+    for (available, description) in header_description.items():
+        if available not in (header for (header, _, _) in meta["columns"]):
+            if description["required"]:
+                return None  # leaving the complaint to columns.load_columns...
+            unmatched.append(description["field"])
+    return (columns.Table(table, meta["rows"]), unmatched, [])
@@ -0,0 +1,46 @@
+#
+# Covering indexes over the peak tables of a study, built once by the index command and recorded in the sequence
+# table (as 'index:<name>' attributes) so that query-building code in the commands can detect and use them.
+#
+
+INDEXES = {
+    # skeleton: m/z (and rt) range extraction of XICs
+    "ms1_peaks_mz_rt": ("ms1_peaks", ("mz", "rt", "rawfile", "intensity")),
+    # ungrid: intensity-ordered walk over every MS1 peak above MIN_SIGNAL
+    "ms1_peaks_intensity": ("ms1_peaks", ("intensity", "mz", "rt", "rawfile")),
+    # precursor_ion: m/z range lookup of MS2 fragments
+    "ms2_peaks_mz": ("ms2_peaks", ("mz", "intensity", "precursor", "rt", "rawfile")),
+    # dewey/timothee: per rawfile, per scan walk of MS2 peaks
+    "ms2_peaks_rawfile_rt": ("ms2_peaks", ("rawfile", "rt", "mz", "intensity")),
+}
+
+RECORDED_SQL = """SELECT attribute FROM sequence WHERE attribute LIKE 'index:%'"""
+EXISTING_SQL = """SELECT name FROM sqlite_master WHERE type = 'index'"""
+FORGET_SQL = """DELETE FROM sequence WHERE attribute = ?"""
+RECORD_SQL = """INSERT INTO sequence (attribute, value) VALUES (?, ?)"""
+
+
+def available(cur):
+    # names of the recorded indexes which (still) exist in the study
+    try:
+        recorded = set(entry[0][len("index:"):] for entry in cur.execute(RECORDED_SQL))
+    except Exception:
+        return set()
+    existing = set(entry[0] for entry in cur.execute(EXISTING_SQL))
+    return set(name for name in recorded if name in existing and name in INDEXES)
+
+
+def indexed_by(cur, name):
+    # an INDEXED BY clause forcing the use of the named index, if the study has it (an empty string otherwise)
+    if name in available(cur):
+        return f" INDEXED BY {name}"
+    return ""
+
+
+def build(con, name):
+    (table, columns) = INDEXES[name]
+    cur = con.cursor()
+    cur.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({', '.join(columns)})")
+    cur.execute(FORGET_SQL, ("index:" + name,))
+    cur.execute(RECORD_SQL, ("index:" + name, f"{table} ({', '.join(columns)})"))
+    con.commit()
@@ -0,0 +1,67 @@
+import itertools
+from array import array
+
+#
+# Isotopologue planning for labeling studies: a labeling spec (the Labeling column of a skeleton .features file)
+# expands into the suffixes and the m/z values of every isotopologue to extract, all of which are then extracted
+# together (see xics.Quantifier).
+#
+# A spec is a label (13C, 15N or 18O), optionally followed by a count or a range of counts in brackets (e.g. 13C[2],
+# 13C[0-3]), a bare label meaning every count from 0 up to the number of such atoms in the formula. Several labels
+# separated by commas (e.g. 13C,15N or 13C[0-2],15N[0-1]) describe their combinations (in the order the labels are
+# given, the last label varying fastest), a bare label then meaning fully labeled.
+#
+
+DELTAS = {
+    "13C": 1.003354838,  # https://en.wikipedia.org/wiki/Isotopes_of_carbon
+    "15N": 0.9970348934,  # https://en.wikipedia.org/wiki/Isotopes_of_nitrogen
+    "18O": 2.0042463804,  # https://en.wikipedia.org/wiki/Isotopes_of_oxygen
+}
+ATOMS = {"13C": "C", "15N": "N", "18O": "O"}
+
+
+class LabelingError(ValueError):
+    pass
+
+
+def parse_label(metabolite, part, atom_counts, in_combination=False):
+    # (label, counts) of a single label of a spec, atom_counts being None when the formula is an m/z value
+    label = part[:3]
+    if label not in DELTAS:
+        raise LabelingError(f"Invalid labeling label {part} for metabolite {metabolite}!!!")
+    counts = part[3:]
+    if counts.startswith("["):
+        counts = counts[1:(-1)]
+        if "-" in counts:
+            (first, last) = counts.split("-")
+            return (label, list(range(int(first), int(last) + 1)))
+        return (label, [int(counts)])
+    if atom_counts is None:
+        raise LabelingError(f"Cannot expand {part} for {metabolite} when the provided 'formula' is an m/z value!!!")
+    atoms = atom_counts.get(ATOMS[label], 0)
+    if in_combination:
+        return (label, [atoms])
+    return (label, list(range(0, atoms + 1)))
+
+
+def plan(metabolite, labeling, base_mz, atom_counts):
+    # (suffixes, m/z values) of the isotopologues of a labeling spec, both empty for an empty spec: base_mz is negative
+    # for negative polarity (and so are the m/z values then), atom_counts maps C, N and O to their number in the
+    # formula (or is None when the formula is an m/z value)
+    if labeling.startswith('"'):
+        labeling = labeling[1:(-1)]
+    if not labeling:  # An empty labeling field will be ignored
+        return ([], array("d"))
+    parts = labeling.split(",")
+    labels = [parse_label(metabolite, part, atom_counts, len(parts) > 1) for part in parts]
+    names = ",".join(label for (label, _) in labels)
+    sign = 1 if base_mz > 0 else -1
+    suffixes = []
+    mzs = array("d")
+    for combination in itertools.product(*(counts for (_, counts) in labels)):
+        suffixes.append(f"-{names}-{','.join(str(count) for count in combination)}")
+        mz = base_mz
+        for ((label, _), count) in zip(labels, combination):
+            mz += sign * (count * DELTAS[label])
+        mzs.append(mz)
+    return (suffixes, mzs)
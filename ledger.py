@@ -0,0 +1,101 @@
+import os
+import sqlite3
+import hits
+
+#
+# The ledger of the library searches run by dewey on a study (kept next to it, in <study>.dewey), so that a rerun on
+# a grown study only needs to search the rawfiles it has not searched yet.
+#
+# A search is identified by its complete MSPepSearch command line (minus input and output files) along with the
+# modification times of the libraries, a rawfile by its name and the digest of its MGF scans (see spectra.MgfWriter),
+# hence a rawfile is searched again as soon as either its scans or the search changes. For every rawfile searched the
+# ledger keeps its hit lines, i.e. its lines of the MSPepSearch .txt output, in their original order.
+#
+
+TABLES_SQL = [
+    """CREATE TABLE IF NOT EXISTS searched (search TEXT, rawfile TEXT, digest TEXT, PRIMARY KEY (search, rawfile))""",
+    """CREATE TABLE IF NOT EXISTS hits (search TEXT, rawfile TEXT, line_number INTEGER, line TEXT)""",
+    """CREATE INDEX IF NOT EXISTS hits_search_rawfile ON hits (search, rawfile, line_number)""",
+    """CREATE TABLE IF NOT EXISTS headers (search TEXT, line_number INTEGER, line TEXT)""",
+]
+SEARCHED_SQL = """SELECT digest FROM searched WHERE search = ? AND rawfile = ?"""
+HITS_SQL = """SELECT line FROM hits WHERE search = ? AND rawfile = ? ORDER BY line_number"""
+HEADER_SQL = """SELECT line FROM headers WHERE search = ? ORDER BY line_number"""
+FORGET_SEARCHED_SQL = """DELETE FROM searched WHERE search = ? AND rawfile = ?"""
+FORGET_HITS_SQL = """DELETE FROM hits WHERE search = ? AND rawfile = ?"""
+FORGET_HEADER_SQL = """DELETE FROM headers WHERE search = ?"""
+RECORD_SEARCHED_SQL = """INSERT INTO searched (search, rawfile, digest) VALUES (?, ?, ?)"""
+RECORD_HIT_SQL = """INSERT INTO hits (search, rawfile, line_number, line) VALUES (?, ?, ?, ?)"""
+RECORD_HEADER_SQL = """INSERT INTO headers (search, line_number, line) VALUES (?, ?, ?)"""
+
+
+def ledger_path(study):
+    if study.endswith(".sqlite3"):
+        study = study[:(-8)]
+    return study + ".dewey"
+
+
+def search_key(command, libraries):
+    # the identity of a search: its command line and the modification time of every library it uses
+    stamps = []
+    for library in libraries:
+        try:
+            stamps.append(f"{library}@{os.stat(library).st_mtime_ns}")
+        except OSError:
+            stamps.append(library)
+    return " ".join(command) + " | " + " ".join(stamps)
+
+
+def split_hits(lines, rawfiles):
+    # (header lines, {rawfile name: hit lines}) of an MSPepSearch .txt output, every hit being attributed to the
+    # (longest) rawfile name its spectrum name starts with, followed by a dot (see spectra.title_rawfile)
+    header = []
+    found = {}
+    for line in lines:
+        if hits.is_header(line):
+            header.append(line)
+            continue
+        spectrum = line.split("\t", 1)[0]
+        dot = len(spectrum)
+        while dot > 0:
+            dot = spectrum.rfind(".", 0, dot)
+            if dot > 0 and spectrum[:dot] in rawfiles:
+                found.setdefault(spectrum[:dot], []).append(line)
+                break
+    return (header, found)
+
+
+class Ledger:
+    def __init__(self, study, search):
+        self.con = sqlite3.connect(ledger_path(study), timeout=60)
+        for sql in TABLES_SQL:
+            self.con.execute(sql)
+        self.con.commit()
+        self.search = search
+
+    def searched(self, rawfile, digest):
+        known = self.con.execute(SEARCHED_SQL, (self.search, rawfile)).fetchone()
+        return known is not None and known[0] == digest
+
+    def hits(self, rawfile):
+        return [line for (line,) in self.con.execute(HITS_SQL, (self.search, rawfile))]
+
+    def header(self):
+        return [line for (line,) in self.con.execute(HEADER_SQL, (self.search,))]
+
+    def record(self, header, hits, digests):
+        # records the header lines and the hit lines (a list per rawfile) of a search of the rawfiles in digests
+        with self.con:
+            if header:
+                self.con.execute(FORGET_HEADER_SQL, (self.search,))
+                self.con.executemany(RECORD_HEADER_SQL, ((self.search, n, line) for (n, line) in enumerate(header)))
+            for (rawfile, digest) in digests.items():
+                self.con.execute(FORGET_SEARCHED_SQL, (self.search, rawfile))
+                self.con.execute(FORGET_HITS_SQL, (self.search, rawfile))
+                self.con.executemany(
+                    RECORD_HIT_SQL, ((self.search, rawfile, n, line) for (n, line) in enumerate(hits.get(rawfile, [])))
+                )
+                self.con.execute(RECORD_SEARCHED_SQL, (self.search, rawfile, digest))
+
+    def close(self):
+        self.con.close()
@@ -1,10 +1,7 @@
 import sys
 import os
 
-from parsers import actions
-from parsers import formula_actions
-from parsers import nist_ion_descriptions
-from parsers import formula
+import parsers
 electron = 0.00054858
 
 #
@@ -173,24 +170,11 @@ def parse_file(f, sourcename, output):
             print("", file=output)
             f.readline()
             if entry.formula:
-                parsed = nist_ion_descriptions.parse(entry.ion_type, actions=actions.Actions())
-                parsed_formula = formula.parse(entry.formula, actions=formula_actions.Actions())
-                the_mz = 0.0
-                for term in parsed_formula:
-                    the_mz += term["mass"]
-                charge = 0
-                z_string = parsed["z"]
-                if z_string == "+":
-                    charge = 1
-                elif z_string == "-":
-                    charge = -1
-                else:
-                    if z_string[-1] == "+":
-                        charge = int(z_string[:(-1)])
-                    else:
-                        charge = (-1) * int(z_string[:(-1)])
+                parsed = parsers.parse_ion_type(entry.ion_type)
+                the_mz = parsers.parse_formula(entry.formula).mass
+                charge = parsed.charge
                 if charge != 0:
-                    predicted_mz = ((the_mz * parsed["molecular_ion_count"]) + parsed["delta"] - (charge * electron)) / abs(charge)
+                    predicted_mz = ((the_mz * parsed.molecular_ion_count) + parsed.delta - (charge * electron)) / abs(charge)
                 else:
                     predicted_mz = 0.0
                 if abs(float(entry.mz) - predicted_mz) > 0.005:
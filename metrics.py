@@ -0,0 +1,150 @@
+import sys
+import json
+import time
+import cProfile
+import pstats
+import datetime
+import contextlib
+
+try:
+    import resource
+except ImportError:  # i.e. win32
+    resource = None
+
+#
+# Machine readable timings of plz commands.
+#
+# Command templates which import metrics get a Metrics object, through which they record named timing spans (along
+# with whatever counts go with them, e.g. the number of GICs quantified). When plz runs with --profile, the command
+# also runs under cProfile and its profile (wall and CPU times, peak RSS, spans and the functions it spent the most time
+# in) is written as JSON next to its <command>_<hash>.py file, in <command>_<hash>.profile.json, the complete cProfile
+# statistics going to <command>_<hash>.pstats. Without --profile, spans are still recorded but go nowhere.
+#
+
+TOP_FUNCTIONS = 30
+
+
+class Metrics:
+    def __init__(self):
+        self.spans = {}  # name -> {"calls": ..., "wall_seconds": ..., "cpu_seconds": ..., counts...}
+
+    @contextlib.contextmanager
+    def span(self, name, **counts):
+        # times the code of a with block (the counts may also be updated from within it, through the yielded dict)
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield counts
+        finally:
+            self._add(name, time.perf_counter() - wall, time.process_time() - cpu, counts)
+
+    def record(self, name, seconds, **counts):
+        # a span timed by the template itself (e.g. with the time.time() stamps it already prints)
+        self._add(name, seconds, None, counts)
+
+    def _add(self, name, wall_seconds, cpu_seconds, counts):
+        span = self.spans.setdefault(name, {"calls": 0, "wall_seconds": 0.0})
+        span["calls"] += 1
+        span["wall_seconds"] += wall_seconds
+        if cpu_seconds is not None:
+            span["cpu_seconds"] = span.get("cpu_seconds", 0.0) + cpu_seconds
+        for (key, value) in counts.items():
+            span[key] = span.get(key, 0) + value
+
+
+def peak_rss():
+    # peak resident set size of this process so far (in bytes), or None when it cannot be found out
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024  # kilobytes everywhere but on macOS
+    try:
+        import ctypes
+        from ctypes import wintypes
+
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [
+                ("cb", wintypes.DWORD),
+                ("PageFaultCount", wintypes.DWORD),
+                ("PeakWorkingSetSize", ctypes.c_size_t),
+                ("WorkingSetSize", ctypes.c_size_t),
+                ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                ("PagefileUsage", ctypes.c_size_t),
+                ("PeakPagefileUsage", ctypes.c_size_t),
+            ]
+
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        if not ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+            return None
+        return counters.PeakWorkingSetSize
+    except (ImportError, AttributeError, OSError):
+        return None
+
+
+def children_cpu_seconds():
+    # CPU time of the (terminated and waited for) child processes, e.g. skeleton workers or MSPepSearch
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def profile_path(cmd_file_name):
+    return cmd_file_name[:(-3)] + ".profile.json"
+
+
+def stats_path(cmd_file_name):
+    return cmd_file_name[:(-3)] + ".pstats"
+
+
+def run_profiled(code, env, words, cmd_file_name, metrics):
+    # exec()s the code of a command under cProfile, writing its profile even when it fails (or exits)
+    started = datetime.datetime.now().isoformat(timespec="seconds")
+    peak_before = peak_rss()
+    children_before = children_cpu_seconds()
+    profiler = cProfile.Profile()
+    completed = False
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    try:
+        profiler.runctx(code, env, env)
+        completed = True
+    finally:
+        wall = time.perf_counter() - wall
+        cpu = time.process_time() - cpu
+        children_after = children_cpu_seconds()
+        profiler.dump_stats(stats_path(cmd_file_name))
+        stats = pstats.Stats(profiler)
+        functions = []
+        for ((filename, line, function), (_, calls, total, cumulative, _)) in sorted(
+            stats.stats.items(), key=lambda item: item[1][3], reverse=True
+        )[:TOP_FUNCTIONS]:
+            functions.append({
+                "function": function,
+                "file": filename,
+                "line": line,
+                "calls": calls,
+                "total_seconds": total,
+                "cumulative_seconds": cumulative,
+            })
+        report = {
+            "command": words[0],
+            "arguments": words[1:],
+            "file": cmd_file_name,
+            "started": started,
+            "completed": completed,
+            "wall_seconds": wall,
+            "cpu_seconds": cpu,
+            "children_cpu_seconds": None if children_before is None else children_after - children_before,
+            "peak_rss_bytes_before": peak_before,
+            "peak_rss_bytes": peak_rss(),
+            "spans": metrics.spans,
+            "functions": functions,
+        }
+        with open(profile_path(cmd_file_name), "w") as f:
+            json.dump(report, f, indent=1)
+        print(f"Profile written to {profile_path(cmd_file_name)} ({wall:.2f} seconds).", file=sys.stderr, flush=True)
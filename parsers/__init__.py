@@ -0,0 +1,161 @@
+import os
+import json
+import atexit
+import hashlib
+import sqlite3
+import collections
+import functools
+from parsers import actions
+from parsers import formula_actions
+from parsers import nist_ion_descriptions
+from parsers import formula
+from parsers import fast_formula
+
+#
+# Cached parsing of ion types and formulas, shared by every command run in the same plz session.
+#
+# The Canopy parsers build a fresh parser (and parse tree) on every call, whereas the same few hundred ion types and
+# formulas are parsed over and over again (once per row of every .features file). parse_ion_type() and
+# parse_formula() only parse a string the first time they see it and return what the commands actually use of the
+# parse, as an immutable (and hence shareable) tuple. Strings which do not parse raise ParseError, every time.
+#
+# When PLZ_PARSERS_CACHE names a file, the parses are also kept there (an sqlite database), so that they survive
+# the plz session. That file is tied to the grammars and element masses it was filled with: it is simply ignored
+# (and refilled) as soon as any of them changes.
+#
+
+CACHE_SIZE = 65536  # per kind of string, which is way more than the distinct ion types and formulas of a study
+DISK_COMMIT_EVERY = 1000
+
+IonType = collections.namedtuple("IonType", "molecular_ion molecular_ion_count delta_formula delta z charge")
+
+
+class Formula(collections.namedtuple("Formula", "mass counts")):
+    # counts are the (element, count) pairs of the formula, in order of first appearance
+    __slots__ = ()
+
+    def count(self, element):
+        for (atom, n) in self.counts:
+            if atom == element:
+                return n
+        return 0
+
+
+class ParseError(formula.ParseError, nist_ion_descriptions.ParseError):
+    # i.e. what either parser raises, so that the existing except clauses keep working
+    pass
+
+
+def _ion_type(text):
+    parsed = nist_ion_descriptions.parse(text, actions=actions.Actions())
+    z = parsed["z"]
+    if z == "+":
+        charge = 1
+    elif z == "-":
+        charge = -1
+    elif z[-1] == "+":
+        charge = int(z[:(-1)])
+    else:
+        charge = (-1) * int(z[:(-1)])
+    return IonType(parsed["molecular_ion"], parsed["molecular_ion_count"], parsed["delta_formula"], parsed["delta"], z, charge)
+
+
+def _formula(text):
+    return Formula(*fast_formula.parse(text))  # i.e. what formula.parse() with formula_actions amounts to
+
+
+KINDS = {
+    "ion_type": (_ion_type, lambda fields: IonType(*fields)),
+    "formula": (_formula, lambda fields: Formula(fields[0], tuple(tuple(pair) for pair in fields[1]))),
+}
+
+
+class DiskCache:
+    def __init__(self, path):
+        self.con = sqlite3.connect(path, timeout=60)
+        self.con.execute("""CREATE TABLE IF NOT EXISTS parses (kind TEXT, version TEXT, text TEXT, parsed TEXT, error TEXT, PRIMARY KEY (kind, version, text))""")
+        self.con.commit()
+        self.version = self._version()
+        self.pending = 0
+        atexit.register(self.commit)
+
+    @staticmethod
+    def _version():
+        # the grammars and actions the parses stored come from
+        md5 = hashlib.md5()
+        for module in (actions, formula_actions, nist_ion_descriptions, formula, fast_formula):
+            try:
+                with open(module.__file__, "rb") as f:
+                    md5.update(f.read())
+            except OSError:  # i.e. frozen
+                md5.update(module.__name__.encode())
+        return md5.hexdigest()
+
+    def get(self, kind, text):
+        return self.con.execute(
+            """SELECT parsed, error FROM parses WHERE kind = ? AND version = ? AND text = ?""", (kind, self.version, text)
+        ).fetchone()
+
+    def put(self, kind, text, parsed, error):
+        self.con.execute(
+            """INSERT OR REPLACE INTO parses (kind, version, text, parsed, error) VALUES (?, ?, ?, ?, ?)""",
+            (kind, self.version, text, parsed, error),
+        )
+        self.pending += 1
+        if self.pending >= DISK_COMMIT_EVERY:
+            self.commit()
+
+    def commit(self):
+        if self.pending:
+            self.con.commit()
+            self.pending = 0
+
+
+disk_cache = None
+if os.environ.get("PLZ_PARSERS_CACHE"):
+    disk_cache = DiskCache(os.environ["PLZ_PARSERS_CACHE"])
+
+
+def _parse(kind, text):
+    # (parse, None) or (None, error message)
+    (parser, from_fields) = KINDS[kind]
+    if disk_cache is not None:
+        known = disk_cache.get(kind, text)
+        if known is not None:
+            (parsed, error) = known
+            return (None, error) if error is not None else (from_fields(json.loads(parsed)), None)
+    try:
+        (parsed, error) = (parser(text), None)
+    except (formula.ParseError, nist_ion_descriptions.ParseError) as e:
+        (parsed, error) = (None, str(e))
+    if disk_cache is not None:
+        disk_cache.put(kind, text, None if parsed is None else json.dumps(parsed), error)
+    return (parsed, error)
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def _cached_ion_type(text):
+    return _parse("ion_type", text)
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def _cached_formula(text):
+    return _parse("formula", text)
+
+
+def parse_ion_type(text):
+    (parsed, error) = _cached_ion_type(text)
+    if error is not None:
+        raise ParseError(error)
+    return parsed
+
+
+def parse_formula(text):
+    (parsed, error) = _cached_formula(text)
+    if error is not None:
+        raise ParseError(error)
+    return parsed
+
+
+def cache_info():
+    return {"ion_type": _cached_ion_type.cache_info(), "formula": _cached_formula.cache_info()}
@@ -0,0 +1,88 @@
+import sys
+import time
+import random
+from parsers import formula
+from parsers import formula_actions
+from parsers import fast_formula
+
+#
+# Checks that fast_formula.parse() agrees with the Canopy formula parser (on the formulas of the files given on the
+# command line, if any, and on random strings) and times both:
+#
+#   python -m parsers.benchmark_formula [file.features ...]
+#
+# A file is taken to be tab separated, with a Formula column.
+#
+
+RANDOM_FORMULAS = 20000
+REPEATS = 5
+
+
+def canopy(text):
+    mass = 0.0
+    counts = {}
+    for term in formula.parse(text, actions=formula_actions.Actions()):
+        mass += term["mass"]
+        counts[term["atom"]] = counts.get(term["atom"], 0) + term["count"]
+    return (mass, tuple(counts.items()))
+
+
+def outcome(parse, text):
+    try:
+        return parse(text)
+    except formula.ParseError:
+        return None
+
+
+def file_formulas(filename):
+    with open(filename) as f:
+        header = f.readline().rstrip("\n").split("\t")
+        if "Formula" not in header:
+            return []
+        column = header.index("Formula")
+        return [line.rstrip("\n").split("\t")[column] for line in f if len(line.split("\t")) > column]
+
+
+def random_formulas(count, seed=0):
+    # mostly well formed formulas, along with a few of everything which should not parse
+    rnd = random.Random(seed)
+    symbols = list(fast_formula.ELEMENTS)
+    pieces = symbols + ["0", "1", "2", "12", "01", "(", ")", "+", "x", "c", "Xx", " "]
+    texts = []
+    for _ in range(count):
+        text = ""
+        for _ in range(rnd.randint(0, 8)):
+            if rnd.random() < 0.9:
+                text += rnd.choice(symbols) + rnd.choice(["", "", str(rnd.randint(1, 60))])
+            else:
+                text += rnd.choice(pieces)
+        texts.append(text)
+    return texts
+
+
+def timed(parse, texts):
+    best = None
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        for text in texts:
+            outcome(parse, text)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+texts = []
+for filename in sys.argv[1:]:
+    texts.extend(file_formulas(filename))
+texts.extend(random_formulas(RANDOM_FORMULAS))
+
+mismatches = [text for text in texts if outcome(canopy, text) != outcome(fast_formula.parse, text)]
+for text in mismatches[:10]:
+    print(f"mismatch on {text!r}: {outcome(canopy, text)} vs {outcome(fast_formula.parse, text)}")
+accepted = sum(1 for text in texts if outcome(canopy, text) is not None)
+print(f"{len(texts)} formulas ({accepted} valid), {len(mismatches)} mismatches")
+
+canopy_seconds = timed(canopy, texts)
+fast_seconds = timed(fast_formula.parse, texts)
+print(f"canopy: {canopy_seconds:.3f} seconds, fast_formula: {fast_seconds:.3f} seconds ({canopy_seconds / fast_seconds:.1f}x)")
+sys.exit(1 if mismatches else 0)
@@ -0,0 +1,50 @@
+from parsers import formula
+from parsers import formula_actions
+
+#
+# A hand written equivalent of formula.parse(text, actions=formula_actions.Actions()), i.e. the same language
+# (formula.peg) and the same masses, without the parse tree.
+#
+# Every element of formula.peg that is a prefix of another one comes after it in its ordered choice, so the
+# element at any position is simply the longest symbol found there: a lookup of the next two characters, then of the
+# next one, in ELEMENTS (which is also where the masses come from).
+#
+
+ELEMENTS = dict(formula_actions.elements)
+DIGITS = "0123456789"
+
+
+def _error(text, offset, expected):
+    return formula.ParseError(formula.format_error(text, offset, expected))
+
+
+def parse(text):
+    # (mass, ((element, count), ...)) of a formula, the mass being summed term by term as formula_actions does and
+    # the counts (of the elements, in order of first appearance) summed over the terms
+    mass = 0.0
+    counts = {}
+    size = len(text)
+    i = 0
+    while True:
+        atom = text[i:(i + 2)]
+        if atom not in ELEMENTS:
+            atom = text[i:(i + 1)]
+            if atom not in ELEMENTS:
+                if i == 0:
+                    raise _error(text, i, ["element"])
+                if i < size:
+                    raise _error(text, i, ["element", "count"] if text[i] in DIGITS else ["element"])
+                break
+        i += len(atom)
+        start = i
+        if i < size and text[i] != "0":
+            while i < size and text[i] in DIGITS:
+                i += 1
+        if i == start:
+            count = 1
+            mass += ELEMENTS[atom]
+        else:
+            count = int(text[start:i])
+            mass += ELEMENTS[atom] * count
+        counts[atom] = counts.get(atom, 0) + count
+    return (mass, tuple(counts.items()))
@@ -0,0 +1,170 @@
+import os
+import re
+import sys
+import time
+import subprocess
+
+#
+# Pipelines (.plz files, run by the dagger command) list plz commands, one per line, each optionally named:
+#
+#     nist: dewey study.sqlite3 False True False True 2 4 True
+#     lipids: dewey study.sqlite3 False False True True 2 4 True
+#     ungrid study.sqlite3 20.0 2.0 100000.0 10.0 0 False 1 1
+#     refined: refine $nist score name True 5 700 0.5 20.0 True False
+#     skeleton study.sqlite3 $refined 15.0 0.2 0.5 1
+#
+# A $name argument stands for the output of the named step (or $name.ext for one of its outputs in particular), which
+# makes that step a dependency. Every other file argument refers to a file in the directory of the pipeline. Steps
+# whose dependencies are satisfied run concurrently (as separate plz processes), steps which already ran (i.e. whose
+# <command>_<hash>.py.done exists) are not run again.
+#
+
+STEP_RE = re.compile(r"^([A-Za-z_][A-Za-z0-9_\-]*):\s+(.*)$")
+REFERENCE_RE = re.compile(r"^\$([A-Za-z_][A-Za-z0-9_\-]*)(\.[A-Za-z0-9_]+)?$")
+
+POLL_INTERVAL = 0.2
+
+
+class Step:
+    __slots__ = ("name", "words", "dependencies", "cmd_file_name", "outputs", "process", "log")
+
+    def __init__(self, name, words, dependencies):
+        self.name = name
+        self.words = words
+        self.dependencies = dependencies
+        self.cmd_file_name = None
+        self.outputs = None
+        self.process = None
+        self.log = None
+
+
+def parse(filename, commands):
+    # the steps of the pipeline, in file order, raising ValueError (with the offending line number) on any problem
+    steps = {}
+    with open(filename) as f:
+        for (number, line) in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            match = STEP_RE.match(line)
+            if match:
+                (name, line) = match.groups()
+            else:
+                name = None
+            words = line.split()
+            if words[0] not in commands:
+                raise ValueError(f"line {number}: unknown command {words[0]}")
+            if words[0] == "dagger":
+                raise ValueError(f"line {number}: pipelines cannot run pipelines")
+            if name is None:
+                name = f"{words[0]}_{number}"
+            if name in steps:
+                raise ValueError(f"line {number}: step {name} is already defined")
+            dependencies = []
+            for word in words[1:]:
+                reference = REFERENCE_RE.match(word)
+                if reference:
+                    dependencies.append(reference.group(1))
+            steps[name] = Step(name, words, dependencies)
+    for step in steps.values():
+        for dependency in step.dependencies:
+            if dependency not in steps:
+                raise ValueError(f"step {step.name} refers to the undefined step {dependency}")
+    # cycles would leave steps that can never run...
+    resolved = set()
+    while len(resolved) < len(steps):
+        ready = [s.name for s in steps.values() if s.name not in resolved and all(d in resolved for d in s.dependencies)]
+        if not ready:
+            raise ValueError(f"circular dependencies between steps {', '.join(sorted(set(steps) - resolved))}")
+        resolved.update(ready)
+    return list(steps.values())
+
+
+def _resolve(step, steps_by_name):
+    # the words of step, with every $name reference replaced by the corresponding output file name
+    words = [step.words[0]]
+    for word in step.words[1:]:
+        reference = REFERENCE_RE.match(word)
+        if reference:
+            (name, extension) = reference.groups()
+            outputs = steps_by_name[name].outputs
+            if extension:
+                candidates = [output for output in outputs if output.endswith(extension)]
+            else:
+                candidates = outputs[:1]
+            if not candidates:
+                raise ValueError(f"step {name} has no {extension or ''} output for step {step.name} to use")
+            word = candidates[0]
+        words.append(word)
+    return words
+
+
+def _finished(step, cmd_file_name, declared_outputs):
+    step.cmd_file_name = cmd_file_name
+    step.outputs = [cmd_file_name[:(-3)] + extension for extension in declared_outputs.get(step.words[0], [])]
+
+
+def run(filename, jobs, plz, log_prefix):
+    # Runs the pipeline in the current directory, at most jobs steps at a time, and returns the names of the steps
+    # which failed (or could not run because a step they depend on failed)
+    steps = parse(filename, plz.commands)
+    steps_by_name = {step.name: step for step in steps}
+    pending = list(steps)
+    running = []
+    done = set()
+    failed = set()
+    while pending or running:
+        for step in list(pending):
+            if any(d in failed for d in step.dependencies):
+                print(f"Skipping {step.name} (a step it depends on failed)...", file=sys.stderr, flush=True)
+                pending.remove(step)
+                failed.add(step.name)
+                continue
+            if len(running) >= jobs or not all(d in done for d in step.dependencies):
+                continue
+            pending.remove(step)
+            try:
+                words = _resolve(step, steps_by_name)
+            except ValueError as e:
+                print(f"Cannot run {step.name}: {e}", file=sys.stderr, flush=True)
+                failed.add(step.name)
+                continue
+            prepared = plz.prepare_command(words, True)
+            if prepared is None:
+                print(f"Cannot run {step.name}: invalid arguments ({' '.join(words)})", file=sys.stderr, flush=True)
+                failed.add(step.name)
+                continue
+            cmd_file_name = prepared[0]
+            if os.path.exists(cmd_file_name + ".done"):
+                print(f"{step.name} is up to date ({cmd_file_name}).", file=sys.stderr, flush=True)
+                _finished(step, cmd_file_name, plz.outputs)
+                done.add(step.name)
+                continue
+            # plz runs a command in the directory of its first file argument, hence the absolute paths...
+            (cmd_args, _, _) = plz.commands[words[0]]
+            arguments = [
+                os.path.abspath(word) if argtype.startswith(".") else word
+                for ((_, argtype, _), word) in zip(cmd_args, words[1:])
+            ]
+            step.log = open(f"{log_prefix}_{step.name}.log", "w")
+            print(f"Starting {step.name}: {' '.join(words)}", file=sys.stderr, flush=True)
+            step.process = subprocess.Popen(plz.launcher + [words[0]] + arguments, stdout=step.log, stderr=subprocess.STDOUT)
+            step.cmd_file_name = cmd_file_name
+            step.words = words
+            running.append(step)
+        if not running:
+            continue
+        time.sleep(POLL_INTERVAL)
+        for step in list(running):
+            if step.process.poll() is None:
+                continue
+            running.remove(step)
+            step.log.close()
+            if step.process.returncode == 0 and os.path.exists(step.cmd_file_name + ".done"):
+                print(f"Finished {step.name}.", file=sys.stderr, flush=True)
+                _finished(step, step.cmd_file_name, plz.outputs)
+                done.add(step.name)
+            else:
+                print(f"{step.name} failed (see {step.log.name}).", file=sys.stderr, flush=True)
+                failed.add(step.name)
+    return sorted(failed)
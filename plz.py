@@ -1,6 +1,7 @@
 import sys
 import os
 import bisect
+import math
 import time
 import sqlite3
 import collections  # for now, plz commands are not allowed to 'from collections import something_specific'
@@ -18,8 +19,21 @@ from parsers import actions
 from parsers import formula_actions
 from parsers import nist_ion_descriptions
 from parsers import formula
+import parsers
 
 import columns
+import xics
+import indexes
+import columnar
+import spill
+import slotting
+import fingerprints
+import pipelines
+import spectra
+import ledger
+import hits
+import isotopologues
+import metrics
 
 #  The imports above are required, at the very least, by the command scripts (and must be passed to namespace),
 #  whereas the ones below are necessitated only by plz itself...
@@ -30,6 +44,7 @@ from prompt_toolkit import PromptSession
 if sys.platform != "linux":
     from gooey import Gooey, GooeyParser
 import hashlib
+import multiprocessing
 
 
 def floatable(value):
@@ -48,6 +63,10 @@ def intable(value):
         return False
 
 
+# Commands may hand work out to a pool of processes (e.g. skeleton with WORKERS > 1), frozen bundles need this
+# before they ever look at sys.argv...
+multiprocessing.freeze_support()
+
 if "--" in sys.argv:  # No clue why gooey does this...
     sys.argv.remove("--")
 
@@ -55,6 +74,11 @@ launch = True
 if "--ignore-gooey" in sys.argv:
     launch = False
     sys.argv.remove("--ignore-gooey")
+# --profile runs every command under cProfile, writing its profile next to it (see metrics.py)
+profile = False
+if "--profile" in sys.argv:
+    profile = True
+    sys.argv.remove("--profile")
 if len(sys.argv) >= 2:
     launch = False
 
@@ -83,7 +107,8 @@ if len(sys.argv) == 2:
     #     f.close()
     # else:
     #     os.chdir(the_arg)
-    os.chdir(the_arg)
+    if __name__ == "__main__":  # spawned worker processes re-import this module from the (already) working directory
+        os.chdir(the_arg)
 if len(sys.argv) > 2:
     words = []
     target_dir = None
@@ -99,7 +124,8 @@ if len(sys.argv) > 2:
         words.append(val)
     # The first file argument dictates the script's working directory!
     if target_dir:
-        os.chdir(target_dir)
+        if __name__ == "__main__":  # spawned worker processes re-import this module from the (already) working directory
+            os.chdir(target_dir)
     else:
         print(
             "current plz command does not specify an implicit working directory!!!",
@@ -114,15 +140,23 @@ templates = [
     if template.endswith(".py")
 ]
 commands = {}
+outputs = {}  # the output file types (e.g. [".features"]) declared by every command
+reusable = {}  # whether the outputs of a command may be copied from an identical run elsewhere (see fingerprints.py)
 for template in templates:
     code = open(bundle_dir + "/" + "commands/" + template)
     body = ""
     args = []
     imports = []
+    outputs[template[:(-3)]] = []
+    reusable[template[:(-3)]] = True
     for line in code:
         if line.startswith("#"):
             vals = line.strip().split(":")
             if vals[0] == "# output":
+                outputs[template[:(-3)]] += vals[1].split()
+                continue
+            if vals[0] == "# reusable":
+                reusable[template[:(-3)]] = vals[1].strip() == "True"
                 continue
             the_val = vals[1].strip()
             sub_vals = the_val.split()
@@ -355,14 +389,17 @@ class MyCustomCompleter(Completer):
                         )
 
 
-def execute_command(words, soft_exit=False):
+def prepare_command(words, soft_exit=False):
+    # Checks the arguments of a command and puts together its complete code, returning the name of the command file
+    # (<command>_<hash>.py) which runs (or already ran) it, its hashed code (i.e. imports included), its code and its
+    # imports... or None (when soft_exit is set) if the arguments are not valid.
     cmd = words[0]
     cmd_complete_code = ""
 
     if cmd not in commands:
         print(f"Invalid command: {cmd}", file=sys.stderr)
         if soft_exit:
-            return
+            return None
         else:
             sys.exit(-1)
     (cmd_args, cmd_code, cmd_imports) = commands[cmd]
@@ -373,7 +410,7 @@ def execute_command(words, soft_exit=False):
     if len(cmd_args) + 1 != len(words):
         print(f"Missing arguments for command {cmd}: {len(cmd_args)} expected, but given only {len(words) - 1}")
         if soft_exit:
-            return
+            return None
         else:
             sys.exit(-1)
     for i, (arg, argtype, constraints) in enumerate(cmd_args):
@@ -381,7 +418,7 @@ def execute_command(words, soft_exit=False):
             if not intable(words[i + 1]):
                 print(f'"{words[i + 1]}" is not a valid integer value for the "{arg}" argument', file=sys.stderr)
                 if soft_exit:
-                    return
+                    return None
                 else:
                     sys.exit(-1)
             else:
@@ -390,7 +427,7 @@ def execute_command(words, soft_exit=False):
             if not floatable(words[i + 1]):
                 print(f'"{words[i + 1]}" is not a valid floating point value for the "{arg}" argument', file=sys.stderr)
                 if soft_exit:
-                    return
+                    return None
                 else:
                     sys.exit(-1)
             else:
@@ -399,7 +436,7 @@ def execute_command(words, soft_exit=False):
             if words[i + 1] not in constraints:
                 print(f'"{words[i + 1]}" not in the valid options for "{arg}" ({" ".join(constraints)})', file=sys.stderr)
                 if soft_exit:
-                    return
+                    return None
                 else:
                     sys.exit(-1)
             else:
@@ -408,15 +445,32 @@ def execute_command(words, soft_exit=False):
             # Since we have no 'free' string type, this means the only option left is a file type...
             # so let us also calculate a hash for it and embed that into the command.
             cmd_complete_code += f'{arg} = "{words[i + 1]}"\n'
-            cmd_complete_code += f'# md5 hash of {words[i + 1]} at time of execution was {hashlib.md5(open(words[i + 1], "rb").read()).hexdigest()}\n'
+            (_, digest) = fingerprints.digest(words[i + 1])
+            cmd_complete_code += f'# md5 hash of {words[i + 1]} at time of execution was {digest}\n'
     cmd_complete_code += cmd_code
     hashed_code = import_code + cmd_complete_code
     hash_object = hashlib.md5(hashed_code.encode("utf-8"))
     hash_val = hash_object.hexdigest()
     new_cmd_file_name = words[0] + "_" + hash_val + ".py"
+    return (new_cmd_file_name, hashed_code, cmd_complete_code, cmd_imports)
+
+
+def execute_command(words, soft_exit=False, profile=False):
+    prepared = prepare_command(words, soft_exit)
+    if prepared is None:
+        return
+    (new_cmd_file_name, hashed_code, cmd_complete_code, cmd_imports) = prepared
     if words[0] != "dagger" and os.path.exists(new_cmd_file_name + ".done"):
         print("Already executed...", file=sys.stderr)
         return
+    if outputs[words[0]] and reusable[words[0]]:
+        # an identical run may also have taken place elsewhere (see fingerprints.py), which is only worth anything to
+        # commands whose outputs are all <command>_<hash> files, i.e. declared ones (not the ones writing next to the
+        # study, e.g. index or export_columnar, nor the ones which opt out, e.g. dewey with its ledger)...
+        previous_directory = fingerprints.reuse_run(new_cmd_file_name)
+        if previous_directory:
+            print(f"Already executed in {previous_directory}, outputs copied...", file=sys.stderr)
+            return
     new_cmd_file = open(new_cmd_file_name, "w")
     print(hashed_code, file=new_cmd_file)
     new_cmd_file.close()
@@ -431,6 +485,8 @@ def execute_command(words, soft_exit=False):
         cmd_env["time"] = time
     if "bisect" in cmd_imports:
         cmd_env["bisect"] = bisect
+    if "math" in cmd_imports:
+        cmd_env["math"] = math
     if "sqlite3" in cmd_imports:
         cmd_env["sqlite3"] = sqlite3
     if "collections" in cmd_imports:
@@ -449,8 +505,20 @@ def execute_command(words, soft_exit=False):
         cmd_env["nist_ion_descriptions"] = nist_ion_descriptions
     if "formula" in cmd_imports:
         cmd_env["formula"] = formula
+    if "parsers" in cmd_imports:
+        cmd_env["parsers"] = parsers
     if "columns" in cmd_imports:
         cmd_env["columns"] = columns
+    if "xics" in cmd_imports:
+        cmd_env["xics"] = xics
+    if "indexes" in cmd_imports:
+        cmd_env["indexes"] = indexes
+    if "columnar" in cmd_imports:
+        cmd_env["columnar"] = columnar
+    if "spill" in cmd_imports:
+        cmd_env["spill"] = spill
+    if "slotting" in cmd_imports:
+        cmd_env["slotting"] = slotting
     # if "dash" in cmd_imports:
     #     cmd_env["dash"] = dash
     # if "dash_cytoscape" in cmd_imports:
@@ -461,12 +529,35 @@ def execute_command(words, soft_exit=False):
     #     cmd_env["threading"] = threading
     # if "flask" in cmd_imports:
     #     cmd_env["flask"] = flask
+    if "spectra" in cmd_imports:
+        cmd_env["spectra"] = spectra
+    if "hits" in cmd_imports:
+        cmd_env["hits"] = hits
+    if "ledger" in cmd_imports:
+        cmd_env["ledger"] = ledger
+    if "isotopologues" in cmd_imports:
+        cmd_env["isotopologues"] = isotopologues
+    command_metrics = metrics.Metrics()
+    if "metrics" in cmd_imports:
+        cmd_env["metrics"] = command_metrics
+    if "pipelines" in cmd_imports:
+        cmd_env["pipelines"] = pipelines
+    if "plz" in cmd_imports:
+        plz_maker = collections.namedtuple("plzobj", "prepare_command commands outputs launcher")
+        if getattr(sys, "frozen", False):
+            launcher = [sys.executable]
+        else:
+            launcher = [sys.executable, os.path.join(bundle_dir, "plz.py")]
+        if profile:
+            launcher.append("--profile")  # i.e. every step of a pipeline gets profiled as well
+        cmd_env["plz"] = plz_maker(prepare_command, commands, outputs, launcher)
     if "mspepsearch" in cmd_imports:
+        # MSPEPSEARCH (in the environment) overrides the location of the MSPepSearch executable, e.g. for a stand-in
         mspepsearch_maker = collections.namedtuple("mspepsearchobj", "path platform NIST Metlin LipidBLAST decoy_NIST decoy_Metlin decoy_LipidBLAST")
         if sys.platform == "win32":
-            cmd_env["mspepsearch"] = mspepsearch_maker(bundle_dir + "/mspepsearch/MSPepSearch64.exe", sys.platform, "C:\\NIST14\\MSSEARCH\\nist_msms", "C:\\NIST14\\MSSEARCH\\METLIN_EXPERIMENTAL", "C:\\NIST14\\MSSEARCH\\LipidBlast_MBX", "C:\\NIST14\\MSSEARCH\\DECOY_nist_msms", "C:\\NIST14\\MSSEARCH\\DECOY_METLIN_EXPERIMENTAL", "C:\\NIST14\\MSSEARCH\\DECOY_LipidBlast_MBX")
+            cmd_env["mspepsearch"] = mspepsearch_maker(os.environ.get("MSPEPSEARCH", bundle_dir + "/mspepsearch/MSPepSearch64.exe"), sys.platform, "C:\\NIST14\\MSSEARCH\\nist_msms", "C:\\NIST14\\MSSEARCH\\METLIN_EXPERIMENTAL", "C:\\NIST14\\MSSEARCH\\LipidBlast_MBX", "C:\\NIST14\\MSSEARCH\\DECOY_nist_msms", "C:\\NIST14\\MSSEARCH\\DECOY_METLIN_EXPERIMENTAL", "C:\\NIST14\\MSSEARCH\\DECOY_LipidBlast_MBX")
         else:
-            cmd_env["mspepsearch"] = mspepsearch_maker("/data/mspepsearch/mspepsearch", sys.platform, "/data/nist_msms", "/data/METLIN_EXPERIMENTAL", "/data/LipidBlast_MBX", "/data/DECOY_nist_msms", "/data/DECOY_METLIN_EXPERIMENTAL", "/data/DECOY_LipidBlast_MBX")
+            cmd_env["mspepsearch"] = mspepsearch_maker(os.environ.get("MSPEPSEARCH", "/data/mspepsearch/mspepsearch"), sys.platform, "/data/nist_msms", "/data/METLIN_EXPERIMENTAL", "/data/LipidBlast_MBX", "/data/DECOY_nist_msms", "/data/DECOY_METLIN_EXPERIMENTAL", "/data/DECOY_LipidBlast_MBX")
     if "lib2nist" in cmd_imports:
         lib2nist_maker = collections.namedtuple("lib2nistobj", "path platform")
         if sys.platform == "win32":
@@ -474,9 +565,13 @@ def execute_command(words, soft_exit=False):
         else:
             cmd_env["lib2nist"] = lib2nist_maker(None, sys.platform)
 
-    exec(cmd_complete_code, cmd_env)
+    if profile:
+        metrics.run_profiled(cmd_complete_code, cmd_env, words, new_cmd_file_name, command_metrics)
+    else:
+        exec(cmd_complete_code, cmd_env)
     with open(new_cmd_file_name + ".done", "w") as finito:
         print("Finished!", file=finito)
+    fingerprints.record_run(new_cmd_file_name)
 
 
 if __name__ == "__main__":
@@ -485,7 +580,7 @@ if __name__ == "__main__":
     else:
         if command_list:
             for words in command_list:
-                execute_command(words)
+                execute_command(words, profile=profile)
         else:
             session = PromptSession()
             while True:
@@ -493,6 +588,12 @@ if __name__ == "__main__":
                     HTML("<green>plz></green> "), completer=MyCustomCompleter()
                 )
                 words = text.split()
+                command_profile = profile
+                if "--profile" in words:
+                    command_profile = True
+                    words.remove("--profile")
+                if not words:
+                    continue
                 cmd = words[0]
                 if cmd == "exit":
                     print_formatted_text(
@@ -506,4 +607,4 @@ if __name__ == "__main__":
                 if cmd not in commands.keys():
                     print("Invalid Command!!!")
                     continue
-                execute_command(words, True)
+                execute_command(words, True, command_profile)
@@ -0,0 +1,214 @@
+import math
+import pathlib
+import sqlite3
+import multiprocessing
+
+import indexes
+import columnar
+import fingerprints
+import spill
+
+#
+# Ungrid's greedy, intensity ordered, assignment of MS1 peaks to feature slots: every peak either falls within the
+# ppm and RT_TOL window of an existing slot, or starts a new slot of its own.
+#
+# Slots only ever interact within a ppm window, so the study can be cut into m/z bands at gaps wider than the window
+# on either side: every band is then an independent problem, which can be solved by a separate worker, and the
+# concatenation of the (m/z sorted) slots of every band is exactly what a single pass over the whole study yields.
+#
+
+# NOTE: peaks of equal intensity are explicitly ordered by rowid (which is how sqlite has always returned them when
+#       sorting the whole table), so that every way of walking the peaks (index, columnar store, spilled runs, m/z bands)
+#       yields the very same features.
+PEAK_SQL = """SELECT ms1_peaks.intensity, ms1_peaks.mz, ms1_peaks.rt, ms1_peaks.rawfile FROM ms1_peaks{indexed_by} WHERE ms1_peaks.rawfile > 0 AND ms1_peaks.intensity > ?{band} ORDER BY ms1_peaks.intensity DESC, ms1_peaks.rowid"""
+UNSORTED_PEAK_SQL = """SELECT -ms1_peaks.intensity, ms1_peaks.rowid, ms1_peaks.mz, ms1_peaks.rt, ms1_peaks.rawfile FROM ms1_peaks WHERE ms1_peaks.rawfile > 0 AND ms1_peaks.intensity > ?{band}"""
+BAND_SQL = """ AND ms1_peaks.mz BETWEEN ? AND ?"""
+MZ_COUNTS_SQL = """SELECT ms1_peaks.mz, COUNT(*) FROM ms1_peaks WHERE ms1_peaks.rawfile > 0 AND ms1_peaks.intensity > ? GROUP BY ms1_peaks.mz ORDER BY ms1_peaks.mz"""
+
+
+#
+# Based on: https://github.com/suzaku/plain_obj
+#
+
+
+def make_constructor(fields):
+    assignments = "\n".join([f"    self.{f} = {f}" for f in fields])
+    parameter_lists = ", ".join(fields)
+    source = "def __init__(self, %s):\n%s" % (parameter_lists, assignments)
+    namespace = {}
+    exec(source, namespace)
+    return namespace["__init__"]
+
+
+def make_lt(key_field):
+    source = (
+        f"def __lt__(self, other):\n    return self.{key_field} < other.{key_field}"
+    )
+    namespace = {}
+    exec(source, namespace)
+    return namespace["__lt__"]
+
+
+def sortable(type_name, field_names):
+    if isinstance(field_names, str):
+        # names separated by whitespace and/or commas
+        field_names = field_names.replace(",", " ").split()
+    return type(
+        type_name,
+        (object,),
+        {
+            "__slots__": field_names,
+            "__init__": make_constructor(field_names),
+            "__lt__": make_lt(field_names[0]),
+        },
+    )
+
+
+Slot = sortable("Slot", "mz rt file min max")
+
+
+def _batched(cursor, batch):
+    # streams the rows of cursor, batch rows at a time, rather than loading all of them at once
+    while True:
+        rows = cursor.fetchmany(batch)
+        if not rows:
+            return
+        yield from rows
+
+
+def peaks(cur, store, min_signal, batch, spill_to_disk, band=None):
+    # (peaks, count) where peaks yields the (intensity, mz, rt, rawfile) of every MS1 peak above min_signal (within
+    # the raw integer m/z band, if any), most intense first, and count is their number (None when streaming)
+    if store:
+        # NOTE: the columnar store (see the export_columnar command) only yields offsets here, which get sorted in
+        #       memory or, just as the rows of the query below, spilled to disk in runs of batch peaks. The peaks
+        #       themselves are read from the memory-mapped columns as they get processed.
+        ms1 = store["ms1_peaks"]
+        (start, stop) = ms1.mz_range(*band) if band else (0, len(ms1))
+        offsets = ms1.by_intensity(min_signal, start, stop, batch, spill_to_disk)
+        if batch > 0 and spill_to_disk:
+            return (ms1.fetch(offsets, "intensity", "mz", "rt", "rawfile"), None)
+        return (ms1.fetch(offsets, "intensity", "mz", "rt", "rawfile"), len(offsets))
+    parameters = (min_signal,) + tuple(band or ())
+    band_sql = BAND_SQL if band else ""
+    if batch > 0 and spill_to_disk:
+        # NOTE: sqlite only streams the (unsorted) peaks here, they get sorted in runs of batch peaks spilled to disk
+        #       (in the current directory) and merged back as they are processed...
+        rows = _batched(cur.execute(UNSORTED_PEAK_SQL.format(band=band_sql), parameters), batch)
+        ordered = spill.sort(rows, batch, "dqiih", directory=".")  # i.e. by decreasing intensity, then rowid
+        return (((-negated, mz, rt, rawfile) for (negated, _, mz, rt, rawfile) in ordered), None)
+    # NOTE: with the ms1_peaks_intensity index (see the index command) the whole study query becomes a walk down the
+    #       index rather than a sort of every peak above min_signal (only peaks of equal intensity still need sorting by
+    #       rowid), while a band is better left to the query planner.
+    indexed_by = "" if band else indexes.indexed_by(cur, "ms1_peaks_intensity")
+    cur.execute(PEAK_SQL.format(indexed_by=indexed_by, band=band_sql), parameters)
+    if batch > 0:
+        return (_batched(cur, batch), None)
+    all_peaks = cur.fetchall()
+    return (all_peaks, len(all_peaks))
+
+
+def window(mz, ppm):
+    if mz > 0.0:
+        return ((1.0 - ppm) * mz, (1.0 + ppm) * mz)
+    return ((1.0 + ppm) * mz, (1.0 - ppm) * mz)
+
+
+def assign(all_peaks, ppm, rt_tol, mass_translation_factor, time_translation_factor):
+    # (slots, count): the slots (sorted by m/z, and by creation order within equal m/z values, exactly as
+    # bisect.insort used to keep them) and the number of peaks processed
+    slots = []
+
+    #
+    # Slots are hashed into a grid of m/z x RT buckets: an RT bucket spans rt_tol minutes and an m/z bucket spans about
+    # one (full) ppm window at m/z 1000, so that assigning a peak only visits a handful of buckets rather than every slot
+    # within the ppm window...
+    #
+    mz_width = max(2.0 * ppm * 1000.0, 1.0 / mass_translation_factor)
+    rt_width = rt_tol if rt_tol > 0 else 1.0
+    grid = {}
+    processed = 0
+    for (intensity, mz, rt, rfile) in all_peaks:
+        processed += 1
+        # NOTE: rt and mz are still raw integers unmodified by time and mass factors!!!
+        mz = float(mz / mass_translation_factor)
+        rt = float(rt / (60 * time_translation_factor))
+        (lower, upper) = window(mz, ppm)
+        assigned = False
+        rt_buckets = range(math.floor((rt - rt_tol) / rt_width), math.floor((rt + rt_tol) / rt_width) + 1)
+        for mz_bucket in range(math.floor(lower / mz_width), math.floor(upper / mz_width) + 1):
+            for rt_bucket in rt_buckets:
+                for slot in grid.get((mz_bucket, rt_bucket), ()):
+                    if lower <= slot.mz <= upper and abs(slot.rt - rt) < rt_tol:
+                        assigned = True
+                        if slot.file == rfile and intensity < slot.min:
+                            slot.min = intensity
+        if not assigned:
+            slot = Slot(mz, rt, rfile, intensity, intensity)
+            slots.append(slot)
+            grid.setdefault((math.floor(mz / mz_width), math.floor(rt / rt_width)), []).append(slot)
+    slots.sort()
+    return (slots, processed)
+
+
+def bands(cur, min_signal, ppm, shards, mass_translation_factor):
+    # Cuts the m/z range of the peaks above min_signal into (at most) shards bands of about the same number of peaks,
+    # returned as inclusive (raw integer) m/z ranges. A cut between two consecutive m/z values a < b is only made when
+    # no peak at or below a has b within its window and no peak at or above b has a within its window (windows grow
+    # with m/z, so checking a and b themselves is enough)...
+    mz_counts = list(cur.execute(MZ_COUNTS_SQL, (min_signal,)))
+    if not mz_counts:
+        return []
+    total = sum(count for (_, count) in mz_counts)
+    result = []
+    start = mz_counts[0][0]
+    so_far = 0
+    for ((mz, count), (next_mz, _)) in zip(mz_counts, mz_counts[1:]):
+        so_far += count
+        if len(result) + 1 < shards and so_far >= total * (len(result) + 1) / shards:
+            a = float(mz / mass_translation_factor)
+            b = float(next_mz / mass_translation_factor)
+            if window(a, ppm)[1] < b and window(b, ppm)[0] > a:
+                result.append((start, mz))
+                start = next_mz
+    result.append((start, mz_counts[-1][0]))
+    return result
+
+
+_band_settings = None
+
+
+def _start_worker(study, settings):
+    global _band_settings
+    # every worker holds its own read-only connection to the study (and its own view of the columnar store)...
+    # ...and opens its own connection to the fingerprints index (checking the columnar store digests the study), as a
+    # forked worker must not use the one it inherited from plz
+    fingerprints._index = None
+    con = sqlite3.connect(pathlib.Path(study).resolve().as_uri() + "?mode=ro", uri=True)
+    cur = con.cursor()
+    _band_settings = (cur, columnar.open_store(cur)) + settings
+
+
+def _process_band(band):
+    return process_band(band, *_band_settings)
+
+
+def process_band(band, cur, store, min_signal, ppm, rt_tol, batch, spill_to_disk, mass_translation_factor, time_translation_factor):
+    (band_peaks, _) = peaks(cur, store, min_signal, batch, spill_to_disk, band)
+    return assign(band_peaks, ppm, rt_tol, mass_translation_factor, time_translation_factor)
+
+
+def process_bands(all_bands, workers, study, cur, store, *settings):
+    # Yields the (slots, count) of every band, in order, whether computed locally or by a pool of workers (settings
+    # are the process_band arguments following the cursor and store)
+    if workers <= 1:
+        for band in all_bands:
+            yield process_band(band, cur, store, *settings)
+        return
+    if "fork" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("fork")
+    else:
+        context = multiprocessing.get_context("spawn")
+    with context.Pool(workers, initializer=_start_worker, initargs=(study, settings)) as pool:
+        for result in pool.imap(_process_band, all_bands):
+            yield result
@@ -0,0 +1,284 @@
+import sys
+import time
+import hashlib
+import itertools
+import operator
+import indexes
+
+#
+# MGF serialization of the MS2 scans of a study (shared by dewey and timothee).
+#
+# Peaks are expected as (rawfile, rt, mz, intensity) rows (still raw integers, see mass_translation_factor and
+# time_translation_factor), grouped by scan, i.e. consecutive rows with the same rawfile and rt form a scan. Every
+# scan is formatted as a whole and handed to a large write buffer in a single write.
+#
+# ms2_scans() provides the scans of a study in (rawfile, rt, mz) order without asking sqlite to sort the whole ms2_peaks
+# table: peaks are either walked in the order of the ms2_peaks_rawfile_rt index (see the index command) or, since
+# raw2sql stores the peaks of every scan next to each other, fetched scan by scan by rowid range(s) and sorted per
+# scan. Only if the peaks turn out to be scattered all over the table does it fall back on the full ORDER BY.
+#
+
+BUFFER_SIZE = 16 * 1024 * 1024
+PROGRESS_PEAKS = 100000
+MAX_RUNS_PER_SCAN = 4
+
+PEAK_SQL = """SELECT ms2_peaks.rawfile, ms2_peaks.rt, ms2_peaks.mz, ms2_peaks.intensity FROM ms2_peaks{indexed_by} WHERE ms2_peaks.rawfile > 0 ORDER BY ms2_peaks.rawfile ASC, ms2_peaks.rt ASC, ms2_peaks.mz ASC, ms2_peaks.rowid ASC"""
+SCAN_RUNS_SQL = """SELECT ms2_peaks.rowid, ms2_peaks.rawfile, ms2_peaks.rt FROM ms2_peaks NOT INDEXED WHERE ms2_peaks.rawfile > 0 ORDER BY ms2_peaks.rowid"""
+SCAN_PEAKS_SQL = """SELECT ms2_peaks.mz, ms2_peaks.intensity FROM ms2_peaks WHERE ms2_peaks.rowid BETWEEN ? AND ? AND ms2_peaks.rawfile = ? AND ms2_peaks.rt = ? ORDER BY ms2_peaks.rowid"""
+
+_scan_key = operator.itemgetter(0, 1)
+_peak_mz = operator.itemgetter(0)
+
+
+def print_query_plan(cur, *queries):
+    # prints the query plan(s) of the (sql, parameters) queries which ms2_scans is about to run, on a single line
+    plans = []
+    for (sql, parameters) in queries:
+        plans.append(", ".join(entry[-1] for entry in cur.execute("EXPLAIN QUERY PLAN " + sql, parameters)))
+    print(f"MS2 scans query plan: {' / '.join(plans)}", file=sys.stderr, flush=True)
+
+
+def _scan_runs(cur):
+    # {(rawfile, rt): [[first rowid, last rowid], ...]} of the MS2 scans, or None if their peaks are scattered over
+    # too many separate rowid ranges for fetching them range by range to make sense: the peaks must come in rowid order
+    # (any covering index over ms2_peaks, e.g. one the index command does not know of, would otherwise be walked
+    # instead, and its order turn the ranges upside down), which SCAN_RUNS_SQL forces
+    runs = {}
+    run_count = 0
+    key = None
+    for (rowid, rawid, rt) in cur.execute(SCAN_RUNS_SQL):
+        if (rawid, rt) != key:
+            key = (rawid, rt)
+            if key in runs:
+                runs[key].append([rowid, rowid])
+            else:
+                runs[key] = [[rowid, rowid]]
+            run_count += 1
+            if run_count > MAX_RUNS_PER_SCAN * len(runs):
+                return None
+        else:
+            run = runs[key][-1]
+            run[0] = min(run[0], rowid)
+            run[1] = max(run[1], rowid)
+    return runs
+
+
+def _sorted_scans(rows):
+    for ((rawid, rt), scan_rows) in itertools.groupby(rows, _scan_key):
+        yield (rawid, rt, [(mz, intensity) for (_, _, mz, intensity) in scan_rows])
+
+
+def ms2_scans(cur):
+    # (rawfile, rt, [(mz, intensity), ...]) of every MS2 scan (of rawfiles > 0), ordered by rawfile, rt and mz, ties
+    # keeping their storage order
+    indexed_by = indexes.indexed_by(cur, "ms2_peaks_rawfile_rt")
+    if indexed_by:
+        sql = PEAK_SQL.format(indexed_by=indexed_by)
+        print_query_plan(cur, (sql, ()))
+        yield from _sorted_scans(cur.execute(sql))
+        return
+    runs = _scan_runs(cur)
+    if runs is None:
+        print("MS2 peaks are not stored scan by scan, sorting all of them...", file=sys.stderr, flush=True)
+        sql = PEAK_SQL.format(indexed_by="")
+        print_query_plan(cur, (sql, ()))
+        yield from _sorted_scans(cur.execute(sql))
+        return
+    print_query_plan(cur, (SCAN_RUNS_SQL, ()), (SCAN_PEAKS_SQL, (0, 0, 0, 0)))
+    for (rawid, rt) in sorted(runs):
+        scan_peaks = []
+        for (first, last) in runs[(rawid, rt)]:
+            scan_peaks += cur.execute(SCAN_PEAKS_SQL, (first, last, rawid, rt)).fetchall()
+        scan_peaks.sort(key=_peak_mz)
+        yield (rawid, rt, scan_peaks)
+
+
+def split_mgf(filename, chunks, scan_count):
+    # Splits the MGF (of scan_count scans) into at most chunks files of consecutive scans, named after it (i.e.
+    # <name>_1.mgf, <name>_2.mgf, ...), and returns their names
+    per_chunk = max(1, -(-scan_count // chunks))
+    names = []
+    out = None
+    written = 0
+    with open(filename) as mgf:
+        for line in mgf:
+            if line.startswith("BEGIN IONS") and (out is None or written == per_chunk):
+                if out is not None:
+                    out.close()
+                names.append(f"{filename[:(-4)]}_{len(names) + 1}.mgf")
+                out = open(names[-1], "w", buffering=BUFFER_SIZE)
+                written = 0
+            if line.startswith("END IONS"):
+                written += 1
+            if out is not None:
+                out.write(line)
+    if out is not None:
+        out.close()
+    return names
+
+
+def title_rawfile(title):
+    # the rawfile name of an MGF TITLE (i.e. <rawfile name>.<scan ID>.<polarity>)
+    return title.rsplit(".", 2)[0]
+
+
+def filter_mgf(filename, out_filename, rawfiles):
+    # copies the scans of the named rawfiles from one MGF into another, and returns how many
+    scan_count = 0
+    keep = False
+    block = []
+    with open(filename) as mgf, open(out_filename, "w", buffering=BUFFER_SIZE) as out:
+        for line in mgf:
+            if line.startswith("BEGIN IONS"):
+                if keep:
+                    out.writelines(block)
+                block = []
+                keep = False
+            elif line.startswith("TITLE="):
+                keep = title_rawfile(line[6:].rstrip("\n")) in rawfiles
+                scan_count += keep
+            block.append(line)
+        if keep:
+            out.writelines(block)
+    return scan_count
+
+
+def write_scans(scans, writers):
+    # writes every (rawfile, rt, peaks) scan with every one of the writers, i.e. in a single pass
+    start = time.time()
+    formatting = sum(writer.format_seconds for writer in writers)
+    reported = writers[0].peak_count // PROGRESS_PEAKS
+    for (rawid, rt, scan_peaks) in scans:
+        for writer in writers:
+            writer.write_scan(rawid, rt, scan_peaks)
+        if writers[0].peak_count // PROGRESS_PEAKS > reported:
+            reported = writers[0].peak_count // PROGRESS_PEAKS
+            print(f"peaks processed = {writers[0].peak_count} ", flush=True)
+    seconds = time.time() - start
+    formatting = sum(writer.format_seconds for writer in writers) - formatting
+    for writer in writers:
+        writer.seconds += seconds
+        writer.read_seconds += seconds - formatting
+
+
+def write_study(cur, writers):
+    # writes every MS2 scan of the study with every one of the writers
+    write_scans(ms2_scans(cur), writers)
+
+
+class ScanWriter:
+    # Base class of the MGF and MSP writers, which only need to provide write_scan (and to count what they write)
+    kind = None
+
+    def __init__(self, filename, all_filenames, all_scans, mass_translation_factor, time_translation_factor):
+        # all_filenames maps rawfile IDs to names, all_scans maps rawfile IDs to {rt: [scan_ID, precursor, ...]}
+        self.filename = filename
+        self.out = open(filename, "w", buffering=BUFFER_SIZE)
+        self.all_filenames = all_filenames
+        self.all_scans = all_scans
+        self.mass_translation_factor = mass_translation_factor
+        self.time_translation_factor = time_translation_factor
+        self.scan_count = 0
+        self.peak_count = 0
+        self.seconds = 0.0
+        self.read_seconds = 0.0
+        self.format_seconds = 0.0
+
+    def scan_fields(self, rawid, rt, scan_peaks):
+        # (title, rt, pepmass and peak lines) of a scan, as they appear in the MGF: scan_peaks are the (mz, intensity)
+        # pairs of one scan, ordered by mz, negative mode (i.e. negative mz) peaks are listed first, in reverse (hence
+        # increasing absolute mz) order
+        mass_translation_factor = self.mass_translation_factor
+        (scan_id, pepmass) = self.all_scans[rawid][rt][:2]  # pepmass is still a raw mz integer from the sqlite file...
+        if pepmass > 0:
+            title = f"{self.all_filenames[rawid]}.{scan_id}.+"
+            pepmass = f"{float(pepmass / mass_translation_factor)}"
+        else:
+            title = f"{self.all_filenames[rawid]}.{scan_id}.-"
+            pepmass = f"{-1 * float(pepmass / mass_translation_factor)}"
+        peak_lines = [f"{float((-mz) / mass_translation_factor)} {intensity}" for (mz, intensity) in scan_peaks if mz < 0]
+        peak_lines.reverse()
+        peak_lines += [f"{float(mz / mass_translation_factor)} {intensity}" for (mz, intensity) in scan_peaks if mz >= 0]
+        return (title, f"{float(rt / self.time_translation_factor)}", pepmass, peak_lines)
+
+    def write_scans(self, scans):
+        write_scans(scans, [self])
+
+    def write_peaks(self, rows):
+        # writes every scan of the (rawfile, rt, mz, intensity) rows
+        write_scans(_sorted_scans(rows), [self])
+
+    def write_study(self, cur):
+        write_study(cur, [self])
+
+    def close(self):
+        self.out.close()
+
+    def report(self):
+        rate = self.peak_count / self.seconds if self.seconds > 0 else 0.0
+        print(
+            f"{self.kind} {self.filename}: {self.peak_count} peaks in {self.scan_count} scans written in {self.seconds:.2f} seconds ({rate:.0f} peaks / second).",
+            file=sys.stderr, flush=True
+        )
+        print(
+            f"{self.kind} {self.filename}: {self.read_seconds:.2f} seconds reading (and ordering) peaks, {self.format_seconds:.2f} seconds formatting them.",
+            file=sys.stderr, flush=True
+        )
+
+
+class MgfWriter(ScanWriter):
+    kind = "MGF"
+
+    def __init__(self, filename, all_filenames, all_scans, mass_translation_factor, time_translation_factor, digest=False):
+        # with digest the writer also keeps (in digests) an md5 of the text written for every rawfile
+        super().__init__(filename, all_filenames, all_scans, mass_translation_factor, time_translation_factor)
+        self.digests = {} if digest else None
+
+    def write_scan(self, rawid, rt, scan_peaks):
+        start = time.time()
+        (title, rt_seconds, pepmass, peak_lines) = self.scan_fields(rawid, rt, scan_peaks)
+        if title[-1] == "+":
+            lines = ["BEGIN IONS", f"TITLE={title}", "CHARGE=127+", f"RTINSECONDS={rt_seconds}", f"PEPMASS={pepmass}"]
+        else:
+            lines = ["BEGIN IONS", f"TITLE={title}", "CHARGE=128-", f"RTINSECONDS={rt_seconds}", f"PEPMASS={pepmass}"]
+        lines += peak_lines
+        lines.append("END IONS\n\n")
+        text = "\n".join(lines)
+        self.out.write(text)
+        if self.digests is not None:
+            if rawid not in self.digests:
+                self.digests[rawid] = hashlib.md5()
+            self.digests[rawid].update(text.encode())
+        self.scan_count += 1
+        self.peak_count += len(scan_peaks)
+        self.format_seconds += time.time() - start
+
+
+class MspWriter(ScanWriter):
+    # The MSP (for lib2nist) timothee used to derive from the MGF, quirks included: names lose the first character of
+    # the MGF title and get the (dot-less) retention time appended, IDs skip the multiples of 65536 (LIB2NIST has a
+    # known bug regarding those, which can thus be circumvented while keeping its default KEEP_IDS setting)
+    kind = "MSP"
+
+    def __init__(self, filename, all_filenames, all_scans, mass_translation_factor, time_translation_factor):
+        super().__init__(filename, all_filenames, all_scans, mass_translation_factor, time_translation_factor)
+        self.current_id = 1
+
+    def write_scan(self, rawid, rt, scan_peaks):
+        start = time.time()
+        (title, rt_seconds, pepmass, peak_lines) = self.scan_fields(rawid, rt, scan_peaks)
+        lines = [
+            f"Name: {title[1:]}.{rt_seconds.replace('.', '')}",
+            f"PrecursorMZ: {pepmass}",
+            f"ID: {self.current_id}",
+            f"Num peaks: {len(peak_lines)}",
+        ]
+        lines += peak_lines
+        lines.append("\n")
+        self.out.write("\n".join(lines))
+        self.current_id += 1
+        if not self.current_id % 65536:
+            self.current_id += 1
+        self.scan_count += 1
+        self.peak_count += len(scan_peaks)
+        self.format_seconds += time.time() - start
@@ -0,0 +1,195 @@
+import os
+import sys
+import heapq
+import itertools
+import struct
+import tempfile
+
+try:
+    import resource
+except ImportError:  # e.g. Windows
+    resource = None
+
+#
+# External (spill to disk) sorting of fixed layout rows, for commands which must walk more rows in order than fit
+# in memory: rows are sorted in runs of run_size, every run is written to a scratch file as packed records, and the
+# runs are then merged back (lazily) with heapq.merge.
+#
+
+READ_RECORDS = 4096
+MAX_RUNS = 128  # number of runs merged at once (and hence of scratch files open at once)
+IN_ORDER_RUN = 2000  # number of records InOrder holds in memory before spilling them
+
+TEXT_RECORD = struct.Struct("=qI")  # i.e. the offset and the (utf-8) length of the text of an InOrder record
+
+
+def _write_run(run, record, directory, number):
+    path = os.path.join(directory, f"run_{number}.bin")
+    with open(path, "wb") as f:
+        f.write(b"".join(record.pack(*row) for row in run))
+    return path
+
+
+def _read_run(path, record):
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(record.size * READ_RECORDS)
+            if not block:
+                return
+            yield from record.iter_unpack(block)
+
+
+def _merge_runs(paths, record, reverse, directory, number):
+    path = os.path.join(directory, f"run_{number}.bin")
+    with open(path, "wb") as f:
+        merged = heapq.merge(*[_read_run(p, record) for p in paths], reverse=reverse)
+        while True:
+            rows = list(itertools.islice(merged, READ_RECORDS))
+            if not rows:
+                break
+            f.write(b"".join(record.pack(*row) for row in rows))
+    for p in paths:
+        os.remove(p)
+    return path
+
+
+def sort(rows, run_size, layout, reverse=False, directory=None):
+    # rows must be tuples matching the struct layout (e.g. "diih"), which also means that values come back with the
+    # types of the layout (an integer intensity stored as "d" comes back as a float)...
+    record = struct.Struct("=" + layout)
+    with tempfile.TemporaryDirectory(prefix="plz_spill_", dir=directory) as scratch:
+        paths = []
+        run = []
+        for row in rows:
+            run.append(row)
+            if len(run) >= run_size:
+                run.sort(reverse=reverse)
+                paths.append(_write_run(run, record, scratch, len(paths)))
+                run = []
+        run.sort(reverse=reverse)
+        if not paths:  # everything fitted in a single run, no need to go through the disk
+            yield from run
+            return
+        if run:
+            paths.append(_write_run(run, record, scratch, len(paths)))
+        del run
+        number = len(paths)
+        while len(paths) > MAX_RUNS:
+            # too many runs to merge in one go: merge them (in order, to keep the merge stable) MAX_RUNS at a time
+            merged = []
+            for first in range(0, len(paths), MAX_RUNS):
+                merged.append(_merge_runs(paths[first:(first + MAX_RUNS)], record, reverse, scratch, number))
+                number += 1
+            paths = merged
+        yield from heapq.merge(*[_read_run(path, record) for path in paths], reverse=reverse)
+
+
+def _write_text_run(run, directory, number):
+    path = os.path.join(directory, f"text_run_{number}.bin")
+    with open(path, "wb") as f:
+        for (offset, text) in run:
+            data = text.encode("utf-8")
+            f.write(TEXT_RECORD.pack(offset, len(data)))
+            f.write(data)
+    return path
+
+
+def _read_text_run(path):
+    with open(path, "rb") as f:
+        while True:
+            header = f.read(TEXT_RECORD.size)
+            if not header:
+                break
+            (offset, length) = TEXT_RECORD.unpack(header)
+            yield (offset, f.read(length).decode("utf-8"))
+    os.remove(path)
+
+
+class InOrder:
+    # Puts (offset, text) records which come in any order (e.g. the results of work done out of order) back in offset
+    # order, i.e. 0, 1, 2, ... every offset being added exactly once: add() releases whatever records have become
+    # contiguous with the ones already released. Records which cannot be released yet are held in memory up to run_size
+    # of them, and then spilled to disk as a sorted run, of which only the next record is held in memory (runs being
+    # merged into a single one whenever there are max_runs of them).
+    def __init__(self, run_size=IN_ORDER_RUN, directory=None, max_runs=MAX_RUNS):
+        self.run_size = run_size
+        self.max_runs = max_runs
+        self.directory = directory
+        self.scratch = None
+        self.next_offset = 0
+        self.pending = []  # heap of the (offset, text) records held in memory
+        self.heads = []  # heap of the (offset, text, run number, run) next records of the spilled runs
+        self.run_count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add(self, offset, text):
+        # returns (an iterator over) the texts of the records released by the addition of this one, in offset order,
+        # which must be consumed before the next addition
+        heapq.heappush(self.pending, (offset, text))
+        if offset != self.next_offset and len(self.pending) >= self.run_size:
+            self._spill()
+        return self._release()
+
+    def _release(self):
+        pending = self.pending
+        heads = self.heads
+        while True:
+            if pending and pending[0][0] == self.next_offset:
+                yield heapq.heappop(pending)[1]
+            elif heads and heads[0][0] == self.next_offset:
+                (_, text, number, run) = heapq.heappop(heads)
+                self._push_head(number, run)
+                yield text
+            else:
+                return
+            self.next_offset += 1
+
+    def _push_head(self, number, run):
+        for (offset, text) in run:
+            heapq.heappush(self.heads, (offset, text, number, run))
+            return
+
+    def _spill(self):
+        if self.scratch is None:
+            self.scratch = tempfile.TemporaryDirectory(prefix="plz_spill_", dir=self.directory)
+        run = sorted(self.pending)
+        self.pending = []
+        path = _write_text_run(run, self.scratch.name, self.run_count)
+        del run
+        self._push_head(self.run_count, _read_text_run(path))
+        self.run_count += 1
+        if len(self.heads) >= self.max_runs:
+            path = _write_text_run(self._merged_heads(), self.scratch.name, self.run_count)
+            self._push_head(self.run_count, _read_text_run(path))
+            self.run_count += 1
+
+    def _merged_heads(self):
+        # (offset, text) of every record of the spilled runs, in offset order, the runs being consumed
+        heads = self.heads
+        while heads:
+            (offset, text, number, run) = heapq.heappop(heads)
+            self._push_head(number, run)
+            yield (offset, text)
+
+    def close(self):
+        for (_, _, _, run) in self.heads:
+            run.close()
+        self.heads = []
+        if self.scratch is not None:
+            self.scratch.cleanup()
+            self.scratch = None
+
+
+def peak_memory():
+    # peak resident set size of the process so far (in MB), or None when it cannot be measured on this platform
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":  # bytes on macOS, kilobytes everywhere else
+        return peak / (1024 * 1024)
+    return peak / 1024
@@ -0,0 +1,79 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+import columnar
+import fingerprints
+
+#
+# Staleness of the columnar store of a small study (the digests of which go to a throw-away fingerprints index).
+#
+
+
+def setUpModule():
+    global cache
+    cache = tempfile.TemporaryDirectory()
+    os.environ["PLZ_CACHE"] = cache.name
+    fingerprints._index = None
+
+
+def tearDownModule():
+    fingerprints._index = None
+    cache.cleanup()
+
+
+class StoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.study = os.path.join(self.directory.name, "study.sqlite3")
+        con = sqlite3.connect(self.study)
+        con.execute("CREATE TABLE ms1_peaks (rawfile INTEGER, rt INTEGER, mz INTEGER, intensity REAL)")
+        con.execute("CREATE TABLE ms2_peaks (rawfile INTEGER, rt INTEGER, mz INTEGER, intensity REAL, precursor INTEGER)")
+        con.executemany(
+            "INSERT INTO ms1_peaks (rawfile, rt, mz, intensity) VALUES (?, ?, ?, ?)",
+            [(1, 1000, 1500000, 10.0), (1, 1000, 900000, 30.0), (2, 2000, -1200000, 20.0)],
+        )
+        con.execute("INSERT INTO ms2_peaks (rawfile, rt, mz, intensity, precursor) VALUES (1, 1100, 800000, 5.0, 1500000)")
+        con.commit()
+        columnar.export(con, self.study, 10000, 1000)
+        con.close()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def modify(self, sql):
+        con = sqlite3.connect(self.study)
+        con.execute(sql)
+        con.commit()
+        con.close()
+
+    def open_store(self):
+        con = sqlite3.connect(self.study)
+        try:
+            return columnar.open_store(con.cursor())
+        finally:
+            con.close()
+
+    def test_current(self):
+        store = self.open_store()
+        self.assertIsNotNone(store)
+        self.assertEqual(list(store["ms1_peaks"].mz), [-1200000, 900000, 1500000])
+
+    def test_in_place_update(self):
+        # same rows, same rowids, different contents
+        self.modify("UPDATE ms1_peaks SET intensity = 40.0 WHERE rowid = 2")
+        self.assertIsNone(self.open_store())
+
+    def test_added_peaks(self):
+        self.modify("INSERT INTO ms2_peaks (rawfile, rt, mz, intensity, precursor) VALUES (1, 1100, 700000, 3.0, 1500000)")
+        self.assertIsNone(self.open_store())
+
+    def test_restamp(self):
+        self.modify("CREATE INDEX ms1_peaks_other ON ms1_peaks (intensity)")
+        self.assertIsNone(self.open_store())
+        columnar.restamp(self.study)
+        self.assertIsNotNone(self.open_store())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+import sqlite3
+import unittest
+import spectra
+
+#
+# spectra.ms2_scans() over a small in-memory study, whose MS2 peaks are stored scan by scan (as raw2sql does).
+#
+
+# (rawfile, rt): [(mz, intensity), ...] in storage order, with both polarities sharing an rt and peaks sharing an mz
+SCANS = {
+    (1, 1000): [(1500000, 10), (900000, 30), (1200000, 20), (900000, 15)],
+    (1, 2000): [(800000, 5), (-700000, 7), (2500000, 9)],
+    (2, 1000): [(-1100000, 11), (-1300000, 13)],
+    (2, 1500): [(3000000, 1), (1000000, 2), (2000000, 3), (500000, 4)],
+}
+
+
+def study():
+    con = sqlite3.connect(":memory:")
+    con.execute("CREATE TABLE ms2_peaks (rawfile INTEGER, rt INTEGER, mz INTEGER, intensity INTEGER, precursor INTEGER)")
+    con.execute("CREATE TABLE sequence (attribute TEXT, value TEXT)")
+    for ((rawfile, rt), peaks) in SCANS.items():
+        con.executemany(
+            "INSERT INTO ms2_peaks (rawfile, rt, mz, intensity, precursor) VALUES (?, ?, ?, ?, 0)",
+            [(rawfile, rt, mz, intensity) for (mz, intensity) in peaks],
+        )
+    con.execute("INSERT INTO ms2_peaks (rawfile, rt, mz, intensity, precursor) VALUES (0, 1000, 100, 1, 0)")
+    con.commit()
+    return con
+
+
+def expected():
+    # ordered by mz, ties keeping their storage order
+    return [(rawfile, rt, sorted(SCANS[(rawfile, rt)], key=lambda peak: peak[0])) for (rawfile, rt) in sorted(SCANS)]
+
+
+class Ms2ScansTest(unittest.TestCase):
+    def test_scan_by_scan(self):
+        con = study()
+        self.assertEqual(list(spectra.ms2_scans(con.cursor())), expected())
+
+    def test_unrecorded_covering_index(self):
+        # an index which the planner would walk (in mz order) instead of the table, were it not for SCAN_RUNS_SQL
+        con = study()
+        con.execute("CREATE INDEX ms2_peaks_other ON ms2_peaks (mz, rt, rawfile)")
+        con.execute("ANALYZE")
+        self.assertEqual(list(spectra.ms2_scans(con.cursor())), expected())
+
+    def test_recorded_index(self):
+        con = study()
+        spectra.indexes.build(con, "ms2_peaks_rawfile_rt")
+        self.assertEqual(list(spectra.ms2_scans(con.cursor())), expected())
+
+    def test_scattered_peaks(self):
+        # peaks interleaved across scans, i.e. several rowid ranges per scan
+        con = sqlite3.connect(":memory:")
+        con.execute("CREATE TABLE ms2_peaks (rawfile INTEGER, rt INTEGER, mz INTEGER, intensity INTEGER, precursor INTEGER)")
+        rows = [(rawfile, rt, mz, intensity) for ((rawfile, rt), peaks) in SCANS.items() for (mz, intensity) in peaks]
+        rows = rows[0::2] + rows[1::2]
+        con.executemany("INSERT INTO ms2_peaks (rawfile, rt, mz, intensity, precursor) VALUES (?, ?, ?, ?, 0)", rows)
+        self.assertEqual(list(spectra.ms2_scans(con.cursor())), expected())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,123 @@
+import os
+import random
+import sqlite3
+import tempfile
+import tracemalloc
+import unittest
+import spill
+import xics
+
+#
+# Sweep by sweep quantification of the entries of a small study (with both polarities), and the in order writing of
+# its results, as skeleton does it.
+#
+
+MASS_TRANSLATION_FACTOR = 10000
+TIME_TRANSLATION_FACTOR = 1000
+
+
+def setUpModule():
+    global directory, study, con, pos_grid, neg_grid
+    directory = tempfile.TemporaryDirectory()
+    study = os.path.join(directory.name, "study.sqlite3")
+    con = sqlite3.connect(study)
+    con.execute("CREATE TABLE ms1_peaks (rawfile INTEGER, rt INTEGER, mz INTEGER, intensity REAL)")
+    generator = random.Random(1)
+    pairs = {"+": [], "-": []}
+    rows = []
+    for rawfile in (1, 2, 3):
+        for rt in range(0, 60000, 500):
+            polarity = "+" if rt % 1000 == 0 else "-"
+            pairs[polarity].append((rawfile, rt))
+            for _ in range(30):
+                mz = generator.randint(1000000, 3000000)
+                rows.append((rawfile, rt, mz if polarity == "+" else -mz, float(generator.randint(1, 1000))))
+    con.executemany("INSERT INTO ms1_peaks (rawfile, rt, mz, intensity) VALUES (?, ?, ?, ?)", rows)
+    con.commit()
+    pos_grid = xics.ScanGrid(pairs["+"], TIME_TRANSLATION_FACTOR)
+    neg_grid = xics.ScanGrid(pairs["-"], TIME_TRANSLATION_FACTOR)
+
+
+def tearDownModule():
+    con.close()
+    directory.cleanup()
+
+
+def entries(count, seed=2):
+    # (polarity, M_mzs, rt_start, rt_stop, mz_tol, rt_tol) entries of 1 to 4 isotopologues, in decreasing m/z order
+    # within each polarity, i.e. the reverse of the order in which they get swept
+    generator = random.Random(seed)
+    made = []
+    for offset in range(count):
+        polarity = "+" if offset % 2 else "-"
+        sign = 1 if polarity == "+" else -1
+        mz = sign * (300.0 - 200.0 * offset / count)
+        rt_start = generator.uniform(0.0, 0.8)
+        made.append((polarity, [mz + sign * 1.003 * k for k in range(generator.randint(1, 4))], rt_start, rt_start + 0.2, 20e-6, 0.05))
+    return made
+
+
+def quantify(some_entries, workers):
+    return xics.quantify_entries(
+        some_entries, workers, study, con, MASS_TRANSLATION_FACTOR, TIME_TRANSLATION_FACTOR, pos_grid, neg_grid
+    )
+
+
+class QuantifyEntriesTest(unittest.TestCase):
+    def setUp(self):
+        self.sweep_targets = xics.SWEEP_TARGETS
+        xics.SWEEP_TARGETS = 50
+
+    def tearDown(self):
+        xics.SWEEP_TARGETS = self.sweep_targets
+
+    def test_workers(self):
+        some_entries = entries(300)
+        batched = [
+            quantified
+            for results in xics.quantify_batches(
+                [some_entries[first:(first + 7)] for first in range(0, len(some_entries), 7)],
+                1, study, con, MASS_TRANSLATION_FACTOR, TIME_TRANSLATION_FACTOR, pos_grid, neg_grid,
+            )
+            for quantified in results
+        ]
+        for workers in (1, 3):
+            self.assertEqual(sorted(quantify(some_entries, workers)), list(enumerate(batched)))
+
+    def test_bounded_memory(self):
+        # once the sweeps are planned, the memory used to quantify (and write out, in order) the entries must grow far
+        # less than their output (of 200 samples, as in the studies skeleton is meant for): no entry may be held until
+        # the end of the run
+        peaks = []
+        sizes = []
+        for count in (400, 3200):
+            some_entries = entries(count)
+            size = 0
+            expected = 0
+            planned = False
+            tracemalloc.start()
+            with spill.InOrder(run_size=50, directory=directory.name, max_runs=4) as in_order:
+                for (offset, quantified) in quantify(some_entries, 1):
+                    if not planned:
+                        tracemalloc.reset_peak()  # i.e. once the sweeps are planned
+                        planned = True
+                    for text in in_order.add(offset, f"{offset}\t{quantified!r}" + "\t0" * 200 + "\n"):
+                        self.assertTrue(text.startswith(f"{expected}\t"))
+                        size += len(text)
+                        expected += 1
+            peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+            sizes.append(size)
+            self.assertEqual(expected, count)
+        self.assertLess(peaks[1] - peaks[0], (sizes[1] - sizes[0]) / 10)
+
+
+class InOrderTest(unittest.TestCase):
+    def test_order(self):
+        offsets = list(range(1000))
+        random.Random(3).shuffle(offsets)
+        with tempfile.TemporaryDirectory() as scratch:
+            with spill.InOrder(run_size=10, directory=scratch, max_runs=4) as in_order:
+                released = [text for offset in offsets for text in in_order.add(offset, f"{offset}\n")]
+            self.assertEqual(released, [f"{offset}\n" for offset in range(1000)])
+            self.assertEqual(os.listdir(scratch), [])
@@ -0,0 +1,411 @@
+import bisect
+import pathlib
+import sqlite3
+import multiprocessing
+from array import array
+
+import indexes
+import columnar
+import fingerprints
+
+#
+# Batched XIC extraction: rather than running one ms1_peaks range query per target (i.e. per metabolite and per
+# isotopologue), all targets of a sweep are loaded into a temporary table and ms1_peaks is swept once, joining
+# every peak against the (m/z sorted) target windows that contain it. Sweeps are planned over all the targets at once
+# (see plan_sweeps): each one holds up to SWEEP_TARGETS targets of a single polarity over a contiguous m/z range, so
+# that 50k targets only take a few passes over ms1_peaks, each of them bounded as narrowly as possible.
+#
+
+SWEEP_TARGETS = 5000
+
+TARGETS_TABLE_SQL = """CREATE TEMP TABLE IF NOT EXISTS xic_targets (id INTEGER PRIMARY KEY, mz_low INTEGER, mz_high INTEGER, rt_start INTEGER, rt_stop INTEGER)"""
+TARGETS_INDEX_SQL = """CREATE INDEX IF NOT EXISTS temp.xic_targets_mz_low ON xic_targets (mz_low)"""
+CLEAR_TARGETS_SQL = """DELETE FROM temp.xic_targets"""
+INSERT_TARGET_SQL = """INSERT INTO temp.xic_targets (id, mz_low, mz_high, rt_start, rt_stop) VALUES (?, ?, ?, ?, ?)"""
+
+# NOTE: CROSS JOIN forces sqlite to keep ms1_peaks as the outer loop, so that the peak table is scanned exactly once
+#       per batch, while the (narrow) m/z window of every peak is looked up in the index of the targets table.
+SWEEP_SQL = """SELECT xic_targets.id, ms1_peaks.rawfile, ms1_peaks.rt, ms1_peaks.intensity, ms1_peaks.mz FROM ms1_peaks CROSS JOIN xic_targets WHERE ms1_peaks.rawfile > 0 AND ms1_peaks.mz >= ? AND ms1_peaks.mz <= ? AND ms1_peaks.rt >= ? AND ms1_peaks.rt <= ? AND xic_targets.mz_low >= ms1_peaks.mz - ? AND xic_targets.mz_low <= ms1_peaks.mz AND xic_targets.mz_high >= ms1_peaks.mz AND xic_targets.rt_start <= ms1_peaks.rt AND xic_targets.rt_stop >= ms1_peaks.rt"""
+
+# When the study holds the ms1_peaks_mz_rt index (see the index command), the loops are reversed: every target
+# window becomes a range lookup into the (covering) index instead.
+INDEXED_SWEEP_SQL = """SELECT xic_targets.id, ms1_peaks.rawfile, ms1_peaks.rt, ms1_peaks.intensity, ms1_peaks.mz FROM xic_targets CROSS JOIN ms1_peaks INDEXED BY ms1_peaks_mz_rt WHERE ms1_peaks.mz >= xic_targets.mz_low AND ms1_peaks.mz <= xic_targets.mz_high AND ms1_peaks.rt >= xic_targets.rt_start AND ms1_peaks.rt <= xic_targets.rt_stop AND ms1_peaks.rawfile > 0"""
+
+def window(polarity, mz, rt_start, rt_stop, mz_tol, mass_translation_factor, time_translation_factor):
+    # retention times are assumed to be provided in minutes and mz is already negative when polarity is "-"
+    if polarity == "+":
+        mz_low = mz * (1.0 - mz_tol)
+        mz_high = mz * (1.0 + mz_tol)
+    else:
+        mz_high = mz * (1.0 - mz_tol)
+        mz_low = mz * (1.0 + mz_tol)
+
+    mz_low = round(mz_low * mass_translation_factor)
+    mz_high = round(mz_high * mass_translation_factor)
+    rt_start = round(rt_start * 60 * time_translation_factor)  # time_translation_factor is in seconds not minutes
+    rt_stop = round(rt_stop * 60 * time_translation_factor)    # time_translation_factor is in seconds not minutes
+    return (mz_low, mz_high, rt_start, rt_stop)
+
+
+class Extractor:
+    def __init__(self, con, mass_translation_factor, time_translation_factor):
+        self.cur = con.cursor()
+        self.mass_translation_factor = mass_translation_factor
+        self.time_translation_factor = time_translation_factor
+        self.cur.execute(TARGETS_TABLE_SQL)
+        self.cur.execute(TARGETS_INDEX_SQL)
+        self.indexed = "ms1_peaks_mz_rt" in indexes.available(self.cur)
+        self.store = columnar.open_store(self.cur)
+
+    def extract(self, targets):
+        # targets are (polarity, mz, rt_start, rt_stop, mz_tol) tuples, the result holds one {(rawfile, rt): (intensity, mz)}
+        # dictionary per target, restricted to the scans where the target was actually observed (mz is still a raw integer,
+        # but with the sign removed for negative polarity targets, exactly as exics used to compare them)...
+        hits = [{} for _ in targets]
+        if not targets:
+            return hits
+        windows = [
+            window(polarity, mz, rt_start, rt_stop, mz_tol, self.mass_translation_factor, self.time_translation_factor)
+            for (polarity, mz, rt_start, rt_stop, mz_tol) in targets
+        ]
+        if self.store:
+            return self._extract_columnar(targets, windows, hits)
+        self.cur.execute(CLEAR_TARGETS_SQL)
+        self.cur.executemany(INSERT_TARGET_SQL, [(offset,) + w for (offset, w) in enumerate(windows)])
+        if self.indexed:
+            self.cur.execute(INDEXED_SWEEP_SQL)
+        else:
+            bounds = (
+                min(w[0] for w in windows),
+                max(w[1] for w in windows),
+                min(w[2] for w in windows),
+                max(w[3] for w in windows),
+                max(w[1] - w[0] for w in windows),
+            )
+            self.cur.execute(SWEEP_SQL, bounds)
+        signs = [1 if target[0] == "+" else -1 for target in targets]
+        for (offset, rawfile, rt, intensity, omz) in self.cur:
+            observed = hits[offset]
+            key = (rawfile, rt)
+            pair = (intensity, signs[offset] * omz)
+            if key not in observed or pair > observed[key]:
+                observed[key] = pair
+        return hits
+
+    def _extract_columnar(self, targets, windows, hits):
+        # with a columnar store (see the export_columnar command), every target window is a bisection of the m/z
+        # column followed by a pass over the (zero-copy) slices of the other columns
+        ms1 = self.store["ms1_peaks"]
+        for ((polarity, *_), (mz_low, mz_high, rt_start, rt_stop), observed) in zip(targets, windows, hits):
+            sign = 1 if polarity == "+" else -1
+            (first, last) = ms1.mz_range(mz_low, mz_high)
+            for (rawfile, rt, intensity, omz) in zip(
+                ms1.rawfile[first:last], ms1.rt[first:last], ms1.intensity[first:last], ms1.mz[first:last]
+            ):
+                if rawfile > 0 and rt_start <= rt <= rt_stop:
+                    key = (rawfile, rt)
+                    pair = (intensity, sign * omz)
+                    if key not in observed or pair > observed[key]:
+                        observed[key] = pair
+        return hits
+
+
+#
+# Compact XIC representation: every target holds, per sample, one intensity and one m/z array aligned with the
+# (shared) scan grid of its polarity, instead of lists of (rt, (intensity, mz)) tuples. Those arrays only span the
+# scans from the first to the last one in which the target was observed (which all lie within its RT window), every
+# other scan of the grid being an implicit zero.
+#
+
+
+class ScanGrid:
+    # The MS1 scans of one polarity (one list of RTs per sample), which every XIC of that polarity is laid over. It is
+    # built once per study and never modified.
+    __slots__ = ("rawfiles", "raw_rts", "rts", "offsets")
+
+    def __init__(self, rawfile_rt_pairs, time_translation_factor):
+        # rawfile_rt_pairs must be ordered by rawfile and rt (see SCAN_SQL in skeleton)
+        float_min_time_factor = 60.0 * float(time_translation_factor)
+        rawfiles = []
+        raw_rts = []
+        for (rawfile, rt) in rawfile_rt_pairs:
+            if not rawfiles or rawfiles[-1] != rawfile:
+                rawfiles.append(rawfile)
+                raw_rts.append([])
+            if raw_rts[-1] and raw_rts[-1][-1] == rt:
+                continue
+            raw_rts[-1].append(rt)
+        self.rawfiles = tuple(rawfiles)
+        self.raw_rts = tuple(tuple(sample_rts) for sample_rts in raw_rts)
+        self.rts = tuple(tuple(rt / float_min_time_factor for rt in sample_rts) for sample_rts in raw_rts)
+        # rawfile -> (sample, {raw rt: offset of the scan within the sample})
+        self.offsets = {
+            rawfile: (sample, {rt: offset for (offset, rt) in enumerate(sample_rts)})
+            for (sample, (rawfile, sample_rts)) in enumerate(zip(self.rawfiles, self.raw_rts))
+        }
+
+    def __len__(self):
+        return len(self.rawfiles)
+
+
+NOTHING = array("d")  # i.e. the (shared) arrays of the samples in which a target was never observed
+
+
+class Xic:
+    __slots__ = ("rts", "firsts", "intensities", "mzs")
+
+    def __init__(self, grid, observed, mass_translation_factor):
+        # observed holds the {(rawfile, rt): (intensity, mz)} maxima produced by Extractor.extract
+        float_mass_factor = float(mass_translation_factor)
+        by_sample = {}
+        for ((rawfile, rt), pair) in observed.items():
+            if not pair > (0, 0):  # Here a (0, -100) would lose out to the default (0, 0)
+                continue
+            located = grid.offsets.get(rawfile)
+            if located is None:
+                continue
+            (sample, offsets) = located
+            offset = offsets.get(rt)
+            if offset is None:
+                raise KeyError((rawfile, rt))
+            by_sample.setdefault(sample, []).append((offset, pair))
+        self.rts = grid.rts
+        self.firsts = [0] * len(grid)  # grid offset of the first scan of the arrays of every sample
+        self.intensities = [NOTHING] * len(grid)
+        self.mzs = [NOTHING] * len(grid)
+        for (sample, located) in by_sample.items():
+            first = min(offset for (offset, _) in located)
+            size = max(offset for (offset, _) in located) + 1 - first
+            intensities = array("d", [0.0]) * size
+            mzs = array("d", [0.0]) * size
+            for (offset, (intensity, mz)) in located:
+                intensities[offset - first] = intensity
+                mzs[offset - first] = mz / float_mass_factor
+            self.firsts[sample] = first
+            self.intensities[sample] = intensities
+            self.mzs[sample] = mzs
+
+    def __len__(self):
+        return len(self.rts)
+
+    def _at(self, sample, offset):
+        # the (intensity, mz) of a sample at a grid offset
+        stored = offset - self.firsts[sample]
+        if 0 <= stored < len(self.intensities[sample]):
+            return (self.intensities[sample][stored], self.mzs[sample][stored])
+        return (0.0, 0.0)
+
+    def _best_stored(self, sample, start, stop, latest):
+        # offset of the maximal (intensity, mz) pair within [start, stop) of the arrays of a sample, ties going to the
+        # earliest (or latest) scan
+        intensities = self.intensities[sample][start:stop]
+        top = max(intensities)
+        ties = intensities.count(top)
+        if ties == 1:
+            return start + intensities.index(top)
+        mzs = self.mzs[sample][start:stop]
+        if ties == len(intensities):
+            best = max(mzs)
+            if latest:
+                return stop - 1 - mzs[::-1].index(best)
+            return start + mzs.index(best)
+        candidates = [offset for offset in range(len(intensities)) if intensities[offset] == top]
+        best = max(mzs[offset] for offset in candidates)
+        candidates = [offset for offset in candidates if mzs[offset] == best]
+        if latest:
+            return start + candidates[-1]
+        return start + candidates[0]
+
+    def _best(self, sample, start, stop, latest):
+        # grid offset of the maximal (intensity, mz) pair within [start, stop), ties going to the earliest (or latest)
+        # scan: every observation being above (0, 0), the implicit zeros only win when the range holds no observation
+        first = self.firsts[sample]
+        low = max(start, first) - first
+        high = min(stop, first + len(self.intensities[sample])) - first
+        if low < high:
+            offset = self._best_stored(sample, low, high, latest)
+            if (self.intensities[sample][offset], self.mzs[sample][offset]) > (0.0, 0.0):
+                return first + offset
+        # typically a sample in which the target was never observed
+        if latest:
+            return stop - 1
+        return start
+
+    def peak(self, sample):
+        # the maximal (intensity, mz, rt) of a sample (the earliest one, should several scans share it)
+        offset = self._best(sample, 0, len(self.rts[sample]), False)
+        return self._at(sample, offset) + (self.rts[sample][offset],)
+
+    def winner(self):
+        # the peak of the first sample holding the maximal (intensity, mz) pair across all samples
+        peaks = [self.peak(sample) for sample in range(len(self.rts))]
+        return max(peaks, key=lambda peak: peak[:2])
+
+    def refined_max(self, sample, tight_start, tight_stop):
+        rts = self.rts[sample]
+        start = bisect.bisect_left(rts, tight_start)
+        stop = bisect.bisect_right(rts, tight_stop)
+        if start >= stop:
+            # This will fail if tight_start to tight_stop is too narrow to afford even one scan per sample!
+            raise ValueError("no scans within the refined rt window")
+        offset = self._best(sample, start, stop, True)
+        return self._at(sample, offset) + (rts[offset],)
+
+    def imposed_max(self, sample, rt):
+        rts = self.rts[sample]
+        offset = bisect.bisect_left(rts, rt)
+        if offset == len(rts) or rts[offset] != rt:
+            raise KeyError(rt)
+        return self._at(sample, offset) + (rt,)
+
+
+#
+# Per entry quantification (i.e. one metabolite and all of its isotopologues), kept here rather than in the skeleton
+# template so that it can run inside worker processes...
+#
+
+
+def quantify(M_measurements, rt_tol):
+    # Returns (mega_winner_offset, mega_winner_intensity, M_finalized_vals, uncovered) where M_finalized_vals holds the
+    # (intensity, mz, rt) of every sample at its imposed rt for every isotopologue, and uncovered is either None or the
+    # (sample_offset, tight_start, tight_stop) of the first sample that affords no scan at all around the mega winner.
+    mega_max = []
+    for M_offset in range(len(M_measurements)):
+        (the_intensity, the_mz, the_rt) = M_measurements[M_offset].winner()
+        mega_max.append(
+            (the_intensity, M_offset, the_rt)
+        )  # (what intensity, which isotope, when)
+    mega_max.sort(reverse=True)
+    mega_winner_intensity = mega_max[0][0]
+    mega_winner_offset = mega_max[0][1]
+    mega_winner_rt = mega_max[0][2]
+    sample_winner_rts = []
+    for sample_offset in range(len(M_measurements[0])):
+        isotope_maxima = []
+        for measurements in M_measurements:
+            try:
+                isotope_maxima.append(
+                    measurements.refined_max(sample_offset, mega_winner_rt - rt_tol, mega_winner_rt + rt_tol)
+                )
+            except ValueError:
+                return (mega_winner_offset, mega_winner_intensity, [], (sample_offset, mega_winner_rt - rt_tol, mega_winner_rt + rt_tol))
+        sample_winner = max(isotope_maxima)
+        sample_winner_rts.append(sample_winner[2])
+    M_finalized_vals = [
+        [
+            measurements.imposed_max(sample_offset, sample_winner_rt)
+            for (sample_offset, sample_winner_rt) in enumerate(sample_winner_rts)
+        ]
+        for measurements in M_measurements
+    ]
+    return (mega_winner_offset, mega_winner_intensity, M_finalized_vals, None)
+
+
+class Quantifier:
+    def __init__(self, con, mass_translation_factor, time_translation_factor, pos_grid, neg_grid):
+        self.extractor = Extractor(con, mass_translation_factor, time_translation_factor)
+        self.mass_translation_factor = mass_translation_factor
+        self.pos_grid = pos_grid
+        self.neg_grid = neg_grid
+
+    def quantify_batch(self, batch):
+        # batch entries are (polarity, M_mzs, rt_start, rt_stop, mz_tol, rt_tol) tuples, one per metabolite, all of
+        # them extracted in a single sweep
+        targets = [
+            (polarity, M_mz, rt_start, rt_stop, mz_tol)
+            for (polarity, M_mzs, rt_start, rt_stop, mz_tol, rt_tol) in batch
+            for M_mz in M_mzs
+        ]
+        observed = self.extractor.extract(targets)
+        results = []
+        offset = 0
+        for (polarity, M_mzs, rt_start, rt_stop, mz_tol, rt_tol) in batch:
+            if polarity == "+":
+                grid = self.pos_grid
+            else:
+                grid = self.neg_grid
+            M_measurements = [
+                Xic(grid, observed[offset + M_offset], self.mass_translation_factor) for M_offset in range(len(M_mzs))
+            ]
+            observed[offset:(offset + len(M_mzs))] = [None] * len(M_mzs)  # i.e. only the compact XICs are kept
+            offset += len(M_mzs)
+            results.append(quantify(M_measurements, rt_tol))
+        return results
+
+
+_quantifier = None
+
+
+def _start_worker(study, mass_translation_factor, time_translation_factor, pos_grid, neg_grid):
+    global _quantifier
+    # every worker holds its own read-only connection to the study...
+    # ...and opens its own connection to the fingerprints index (checking the columnar store digests the study), as a
+    # forked worker must not use the one it inherited from plz
+    fingerprints._index = None
+    con = sqlite3.connect(pathlib.Path(study).resolve().as_uri() + "?mode=ro", uri=True)
+    _quantifier = Quantifier(con, mass_translation_factor, time_translation_factor, pos_grid, neg_grid)
+
+
+def _quantify_batch(batch):
+    return _quantifier.quantify_batch(batch)
+
+
+def quantify_batches(batches, workers, study, con, mass_translation_factor, time_translation_factor, pos_grid, neg_grid):
+    # Yields the quantify_batch results of every batch, in order, whether computed locally or by a pool of workers
+    if workers <= 1:
+        quantifier = Quantifier(con, mass_translation_factor, time_translation_factor, pos_grid, neg_grid)
+        for batch in batches:
+            yield quantifier.quantify_batch(batch)
+        return
+    if "fork" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("fork")
+    else:
+        context = multiprocessing.get_context("spawn")
+    with context.Pool(
+        workers,
+        initializer=_start_worker,
+        initargs=(study, mass_translation_factor, time_translation_factor, pos_grid, neg_grid),
+    ) as pool:
+        for results in pool.imap(_quantify_batch, batches):
+            yield results
+
+
+def plan_sweeps(entries, workers):
+    # Groups the offsets of the (polarity, M_mzs, ...) entries into sweeps of a single polarity, in m/z order, each of
+    # them holding up to SWEEP_TARGETS targets (fewer when that makes enough sweeps to keep every worker busy), the
+    # offsets of every sweep being kept in an array
+    target_count = sum(len(entry[1]) for entry in entries)
+    size = max(1, min(SWEEP_TARGETS, -(-target_count // max(workers, 1))))
+    order = array("q", sorted(range(len(entries)), key=lambda offset: (entries[offset][0], min(entries[offset][1]))))
+    sweeps = []
+    first = 0
+    sweep_size = 0
+    for (position, offset) in enumerate(order):
+        if position > first and (sweep_size >= size or entries[order[position - 1]][0] != entries[offset][0]):
+            sweeps.append(order[first:position])
+            first = position
+            sweep_size = 0
+        sweep_size += len(entries[offset][1])
+    if first < len(order):
+        sweeps.append(order[first:])
+    return sweeps
+
+
+def quantify_entries(entries, workers, study, con, mass_translation_factor, time_translation_factor, pos_grid, neg_grid):
+    # Yields the (offset, quantify result) of every (polarity, M_mzs, rt_start, rt_stop, mz_tol, rt_tol) entry, sweep by
+    # sweep (see plan_sweeps) as soon as each one completes, i.e. not in entry order (see spill.InOrder)
+    sweeps = plan_sweeps(entries, workers)
+    for (sweep, sweep_results) in zip(
+        sweeps,
+        quantify_batches(
+            ([entries[offset] for offset in sweep] for sweep in sweeps),
+            workers,
+            study,
+            con,
+            mass_translation_factor,
+            time_translation_factor,
+            pos_grid,
+            neg_grid,
+        ),
+    ):
+        yield from zip(sweep, sweep_results)